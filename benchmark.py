@@ -0,0 +1,237 @@
+from contextlib import redirect_stdout
+from cost_functions import batched_cost_v1, batched_cost_v2
+from history import ValueFnHistory
+from policy_iteration import PolicyIteration
+from value_iteration import ValueIteration
+from world import World
+
+import argparse
+import io
+import json
+import numpy as np
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+COST_FNS = {
+    'v1': batched_cost_v1,
+    'v2': batched_cost_v2,
+}
+
+# Factories which create a solver from (world, one-step cost function, discount factor, eps). Histories are disabled so
+# that only the memory used by the solvers themselves is measured.
+SOLVERS = {
+    'vi_loop':         lambda w, c, g, e: ValueIteration(w, c, g, e, engine='loop', history=ValueFnHistory('off')),
+    'vi_vectorized':   lambda w, c, g, e: ValueIteration(w, c, g, e, engine='vectorized',
+                                                         history=ValueFnHistory('off')),
+    'vi_gauss_seidel': lambda w, c, g, e: ValueIteration(w, c, g, e, engine='gauss_seidel', ordering='goal_bfs',
+                                                         history=ValueFnHistory('off')),
+    'vi_prioritized':  lambda w, c, g, e: ValueIteration(w, c, g, e, engine='prioritized',
+                                                         history=ValueFnHistory('off')),
+    'pi_dense':        lambda w, c, g, e: PolicyIteration(w, c, g, history=ValueFnHistory('off')),
+    'pi_sparse':       lambda w, c, g, e: PolicyIteration(w, c, g, engine='vectorized', evaluation='sparse',
+                                                          history=ValueFnHistory('off')),
+    'pi_modified':     lambda w, c, g, e: PolicyIteration(w, c, g, engine='vectorized', evaluation='modified',
+                                                          tol=e, history=ValueFnHistory('off')),
+}
+
+# solvers which build dense matrices or loop over states in Python are only run on small worlds
+SLOW_SOLVERS = ('vi_loop', 'pi_dense')
+
+# exact solver against which the value functions of all other solvers are compared
+REFERENCE_SOLVER = 'pi_sparse'
+
+
+def generate_maze(width, height, density, seed=0):
+    """
+    Generates a random maze in the token format of 'world_map.txt'. A perfect maze is carved out by a randomized
+    depth-first search, after which a random fraction (1 - density) of its inner walls is removed again to create loops
+    and open areas.
+
+    :param width: Width of the maze including the outer walls. Rounded up to an odd number.
+    :param height: Height of the maze including the outer walls. Rounded up to an odd number.
+    :param density: Fraction of the inner walls of the perfect maze which are kept, in range [0, 1]
+    :param seed: Seed of the random number generator
+    :return: 2D array of tokens
+    """
+    rng = np.random.RandomState(seed)
+    width, height = width | 1, height | 1
+    cells_x, cells_y = (width - 1) // 2, (height - 1) // 2
+
+    maze = np.full((height, width), '1')
+    visited = np.zeros((cells_y, cells_x), bool)
+    stack = [(0, 0)]
+    visited[0, 0] = True
+    maze[1, 1] = '0'
+
+    while stack:
+        cx, cy = stack[-1]
+        neighbours = [(cx + dx, cy + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                      if 0 <= cx + dx < cells_x and 0 <= cy + dy < cells_y and not visited[cy + dy, cx + dx]]
+        if not neighbours:
+            stack.pop()
+            continue
+
+        nx, ny = neighbours[rng.randint(len(neighbours))]
+        visited[ny, nx] = True
+        maze[2 * ny + 1, 2 * nx + 1] = '0'
+        maze[cy + ny + 1, cx + nx + 1] = '0'
+        stack.append((nx, ny))
+
+    inner_walls = np.argwhere(maze[1:-1, 1:-1] == '1') + 1
+    removed = inner_walls[rng.rand(len(inner_walls)) >= density]
+    maze[removed[:, 0], removed[:, 1]] = '0'
+
+    free_cells = np.argwhere(maze == '0')
+    maze[1, 1] = 'S'
+    maze[2 * cells_y - 1, 2 * cells_x - 1] = 'G'
+    trap_y, trap_x = free_cells[rng.randint(len(free_cells))]
+    if maze[trap_y, trap_x] == '0':
+        maze[trap_y, trap_x] = 'T'
+
+    return maze
+
+
+def write_maze(maze, filepath):
+    with open(filepath, 'w') as writefile:
+        writefile.write("# Procedurally generated maze, see benchmark.py\n")
+        for row in maze:
+            writefile.write(' '.join(row) + '\n')
+
+
+def run_solver(solver_name, world, one_step_cost_fn, gamma, eps, measure_memory):
+    def solve():
+        solver = SOLVERS[solver_name](world, one_step_cost_fn, gamma, eps)
+        with redirect_stdout(io.StringIO()):
+            value_fn = solver.execute()
+        return solver.iterations, solver.value_fn if value_fn is None else value_fn
+
+    start_time = time.perf_counter()
+    iterations, value_fn = solve()
+    wall_time = time.perf_counter() - start_time
+
+    peak_memory = None
+    if measure_memory:
+        # memory is measured in a separate run, since tracing allocations slows down the solvers
+        tracemalloc.start()
+        solve()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return wall_time, iterations, peak_memory, value_fn
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    with open(baseline_path) as readfile:
+        baseline = json.load(readfile)
+
+    def key(result):
+        return result['size'], result['density'], result['gamma'], result['cost_fn'], result['solver']
+
+    baseline_times = dict((key(result), result['wall_time']) for result in baseline['results'])
+    regressions = 0
+
+    for result in results:
+        if key(result) not in baseline_times:
+            continue
+
+        ratio = result['wall_time'] / max(baseline_times[key(result)], 1e-9)
+        result['baseline_ratio'] = ratio
+        if ratio > tolerance:
+            regressions += 1
+            print("REGRESSION: %s on %dx%d (density %.2f, gamma %.3f, cost %s) is %.2fx slower than the baseline" %
+                  (result['solver'], result['size'], result['size'], result['density'], result['gamma'],
+                   result['cost_fn'], ratio))
+
+    print("%d regression(s) with respect to %s" % (regressions, baseline_path))
+    return regressions
+
+
+def main(args):
+    maze_dir = args.maze_dir if args.maze_dir else tempfile.mkdtemp(prefix='mazes_')
+    if not os.path.exists(maze_dir):
+        os.makedirs(maze_dir)
+
+    solver_names = args.solvers if args.solvers else sorted(SOLVERS.keys())
+    for solver_name in solver_names:
+        if solver_name not in SOLVERS:
+            raise ValueError("Unknown solver '%s'. Must be one of %s" % (solver_name, ', '.join(sorted(SOLVERS))))
+
+    results = list()
+    print("%-16s %6s %7s %6s %4s %10s %6s %10s %10s" % ('solver', 'size', 'density', 'gamma', 'cost', 'time [s]',
+                                                         'iters', 'peak [MB]', 'max error'))
+
+    for size in args.sizes:
+        for density in args.densities:
+            maze_path = os.path.join(maze_dir, 'maze_%d_%.2f.txt' % (size, density))
+            write_maze(generate_maze(size, size, density, args.seed), maze_path)
+
+            start_time = time.perf_counter()
+            world = World(maze_path)
+            load_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            world.compile()
+            compile_time = time.perf_counter() - start_time
+
+            for gamma in args.gammas:
+                for cost_name in args.cost_fns:
+                    one_step_cost_fn = COST_FNS[cost_name]
+                    reference = run_solver(REFERENCE_SOLVER, world, one_step_cost_fn, gamma, args.eps, False)[3]
+
+                    for solver_name in solver_names:
+                        if solver_name in SLOW_SOLVERS and world.world_width > args.max_slow_size:
+                            continue
+
+                        wall_time, iterations, peak_memory, value_fn = run_solver(
+                            solver_name, world, one_step_cost_fn, gamma, args.eps, not args.skip_memory)
+                        max_error = float(np.max(np.absolute(value_fn.astype(np.float64) - reference)))
+
+                        result = {
+                            'solver': solver_name, 'size': world.world_width, 'density': density, 'gamma': gamma,
+                            'cost_fn': cost_name, 'eps': args.eps, 'num_states': world.compile().num_states,
+                            'load_time': load_time, 'compile_time': compile_time, 'wall_time': wall_time,
+                            'iterations': int(iterations), 'peak_memory': peak_memory, 'max_value_error': max_error,
+                        }
+                        results.append(result)
+
+                        print("%-16s %6d %7.2f %6.3f %4s %10.4f %6d %10s %10.2e" %
+                              (solver_name, world.world_width, density, gamma, cost_name, wall_time, iterations,
+                               '-' if peak_memory is None else '%.1f' % (peak_memory / 2. ** 20), max_error))
+
+    report = {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+    if args.baseline:
+        report['regressions'] = compare_with_baseline(results, args.baseline, args.tolerance)
+
+    with open(args.output, 'w') as writefile:
+        json.dump(report, writefile, indent=2)
+    print("Results written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the solvers on procedurally generated mazes.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[11, 21, 51])
+    parser.add_argument('--densities', type=float, nargs='+', default=[1.0, 0.5])
+    parser.add_argument('--gammas', type=float, nargs='+', default=[0.9, 0.99])
+    parser.add_argument('--cost-fns', nargs='+', default=sorted(COST_FNS.keys()), choices=sorted(COST_FNS.keys()))
+    parser.add_argument('--solvers', nargs='+', required=False)
+    parser.add_argument('--eps', type=float, default=10e-7)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-slow-size', type=int, default=21,
+                        help="Largest world size on which the loop and dense solvers are run")
+    parser.add_argument('--skip-memory', action='store_true', help="Do not measure peak memory")
+    parser.add_argument('--maze-dir', required=False, help="Directory in which the generated mazes are kept")
+    parser.add_argument('--output', '-o', default='benchmark_results.json')
+    parser.add_argument('--baseline', required=False, help="Results of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="Slowdown with respect to the baseline above which a run counts as a regression")
+    main(parser.parse_args())
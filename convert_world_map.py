@@ -0,0 +1,23 @@
+from world import World
+
+import argparse
+import os
+
+
+def main(args):
+    if not os.path.exists(args.input):
+        raise IOError("World map definition not found at its expected path: %s" % args.input)
+
+    output_path = args.output if args.output else os.path.splitext(args.input)[0] + '.wmap'
+
+    print("Converting world from %s to %s" % (args.input, output_path))
+    world = World(args.input)
+    world.write_binary_world_map(output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Converts a text world map definition into the binary world map "
+                                                 "format, which can be loaded in constant time.")
+    parser.add_argument('input')
+    parser.add_argument('--output', '-o', required=False)
+    main(parser.parse_args())
@@ -0,0 +1,148 @@
+import hashlib
+import numpy as np
+import types
+
+# A one-step cost function is either a scalar function of the form fn(world, current_pos, next_pos) which returns the
+# cost of a single transition, or a batched function of the same signature which receives arrays of positions of shape
+# [M, 2] and returns an array of M costs. Batched functions are marked with the 'batched_cost_fn' decorator.
+
+
+def batched_cost_fn(fn):
+    """
+    Marks a one-step cost function as implementing the batched protocol.
+
+    :param fn: Method that returns the one step costs given an instance of World, an array of current positions and an
+    array of next positions
+    :return: The same method
+    """
+    fn.is_batched = True
+    return fn
+
+
+def is_batched(one_step_cost_fn):
+    return getattr(one_step_cost_fn, 'is_batched', False)
+
+
+class ScalarCostAdapter(object):
+    def __init__(self, one_step_cost_fn):
+        """
+        Adapts a scalar one-step cost function to the batched protocol by calling it once per transition.
+
+        :param one_step_cost_fn: Method that returns the one step cost given an instance of World, the current position
+        and the next position
+        """
+        self.one_step_cost_fn = one_step_cost_fn
+        self.is_batched = True
+
+    def __call__(self, world, current_positions, next_positions):
+        return np.array([self.one_step_cost_fn(world, current_pos, next_pos)
+                         for current_pos, next_pos in zip(current_positions, next_positions)], np.float64)
+
+
+def as_batched(one_step_cost_fn):
+    """
+    Returns a batched version of the given one-step cost function.
+
+    :param one_step_cost_fn: Scalar or batched one-step cost function
+    :return: Batched one-step cost function
+    """
+    if is_batched(one_step_cost_fn):
+        return one_step_cost_fn
+    return ScalarCostAdapter(one_step_cost_fn)
+
+
+def cost_fn_identity(one_step_cost_fn):
+    """
+    Returns an identity of a one-step cost function which is stable across runs, e.g. for keying cached solutions. It is
+    derived from the qualified name and the compiled code of the function, so that editing the function changes it.
+
+    :param one_step_cost_fn: Scalar or batched one-step cost function
+    :return: Hex digest
+    """
+    if isinstance(one_step_cost_fn, ScalarCostAdapter):
+        one_step_cost_fn = one_step_cost_fn.one_step_cost_fn
+
+    digest = hashlib.sha256()
+    if isinstance(one_step_cost_fn, types.FunctionType):
+        fn = one_step_cost_fn
+    else:
+        # callable objects are identified by their class, their attributes and the code of '__call__'
+        fn = type(one_step_cost_fn).__call__
+        digest.update(repr(sorted(vars(one_step_cost_fn).items())).encode())
+
+    def update(code):
+        # the repr of nested code objects contains their memory address, so they are hashed recursively instead
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names).encode())
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                update(const)
+            else:
+                digest.update(repr(const).encode())
+
+    digest.update(("%s.%s" % (fn.__module__, fn.__qualname__)).encode())
+    digest.update(repr(fn.__defaults__).encode())
+    update(fn.__code__)
+    return digest.hexdigest()
+
+
+def transition_costs(world, one_step_cost_fn):
+    """
+    Returns the one-step cost of every transition of the compiled transition model of the world. The costs are computed
+    only once per cost function and cached on the transition model, so that all solvers for the same world reuse them.
+
+    :param world: Instance of class 'World'
+    :param one_step_cost_fn: Scalar or batched one-step cost function
+    :return: Array of shape [num_transitions]
+    """
+    model = world.compile()
+    if one_step_cost_fn not in model.cost_cache:
+        current_positions = model.states[model.rows // model.num_actions]
+        next_positions = model.states[model.next_states]
+        costs = np.asarray(as_batched(one_step_cost_fn)(world, current_positions, next_positions), np.float64)
+        if costs.shape != (model.num_transitions,):
+            raise ValueError("Batched one-step cost function returned an array of shape %s, expected (%d,)" %
+                             (str(costs.shape), model.num_transitions))
+        model.cost_cache[one_step_cost_fn] = costs
+    return model.cost_cache[one_step_cost_fn]
+
+
+# Two possible implementations for the one-step cost are provided, each in a scalar and a batched version
+
+
+def one_step_cost_v1(world, current_pos, next_pos):
+    # Reaching the goal yields -1 cost, falling into the trap yields a cost of 50, and all other transitions give
+    # zero cost.
+    if (next_pos == world.goal_pos).all():
+        return -1.
+    elif (next_pos == world.trap_pos).all():
+        return 50.
+    else:
+        return 0.
+
+
+def one_step_cost_v2(world, current_pos, next_pos):
+    # Reaching the goal yields -1 cost, falling into the trap yields a cost of 50, and all other transitions give
+    # a cost of 1.
+    if (current_pos == world.goal_pos).all() and (next_pos == world.goal_pos).all():
+        return 0.
+    elif (next_pos == world.trap_pos).all():
+        return 50.
+    else:
+        return 1.
+
+
+@batched_cost_fn
+def batched_cost_v1(world, current_positions, next_positions):
+    costs = np.zeros(len(next_positions), np.float64)
+    costs[(next_positions == world.trap_pos).all(axis=1)] = 50.
+    costs[(next_positions == world.goal_pos).all(axis=1)] = -1.
+    return costs
+
+
+@batched_cost_fn
+def batched_cost_v2(world, current_positions, next_positions):
+    costs = np.ones(len(next_positions), np.float64)
+    costs[(next_positions == world.trap_pos).all(axis=1)] = 50.
+    costs[(current_positions == world.goal_pos).all(axis=1) & (next_positions == world.goal_pos).all(axis=1)] = 0.
+    return costs
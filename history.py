@@ -0,0 +1,112 @@
+from collections import deque
+
+import numpy as np
+import os
+import struct
+
+
+class ValueFnHistory(object):
+    MODES = ('all', 'off', 'last', 'disk')
+
+    # size of the .npy header of on-disk stores. It is fixed so that the header can be rewritten in place whenever a
+    # snapshot is appended.
+    NPY_HEADER_SIZE = 128
+
+    def __init__(self, mode='all', size=10, interval=1, path=None):
+        """
+        Ctor for a bounded record of the value function at every iteration of a solver. Behaves like a list of 2D
+        arrays.
+
+        :param mode: 'all' keeps every recorded snapshot in memory, 'off' keeps none, 'last' keeps the most recent
+        'size' snapshots in a ring buffer and 'disk' streams the snapshots to a .npy file at 'path' which can be read
+        back lazily.
+        :param size: Number of snapshots kept by mode 'last'
+        :param interval: Only every 'interval'-th snapshot passed to 'append' is recorded
+        :param path: Full path to the .npy file written by mode 'disk'
+        """
+        if mode not in self.MODES:
+            raise ValueError("Unknown history mode '%s'. Must be one of %s" % (mode, ', '.join(self.MODES)))
+        if mode == 'disk' and path is None:
+            raise ValueError("A path is required for history mode 'disk'")
+
+        self.mode = mode
+        self.interval = interval
+        self.path = path
+
+        self.__num_appended = 0
+        self.__snapshots = deque(maxlen=size) if mode == 'last' else list()
+        self.iterations = deque(maxlen=size) if mode == 'last' else list()
+
+        self.__store_shape = None
+        self.__store_dtype = None
+
+        if mode == 'disk' and os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def load(path):
+        """
+        Opens an on-disk store written by mode 'disk' for lazy reading.
+
+        :param path: Full path to the .npy file
+        :return: Read-only memory map of shape [num_snapshots, H, W]
+        """
+        return np.load(path, mmap_mode='r')
+
+    def append(self, value_fn):
+        """
+        Records a snapshot of the value function, subject to the history mode and interval.
+
+        :param value_fn: Value function as a 2D array
+        :return: None
+        """
+        iteration = self.__num_appended
+        self.__num_appended += 1
+
+        if self.mode == 'off' or iteration % self.interval != 0:
+            return
+
+        self.iterations.append(iteration)
+        if self.mode == 'disk':
+            self.__write(value_fn)
+        else:
+            self.__snapshots.append(value_fn)
+
+    def __write(self, value_fn):
+        value_fn = np.ascontiguousarray(value_fn)
+        if self.__store_shape is None:
+            self.__store_shape = value_fn.shape
+            self.__store_dtype = value_fn.dtype
+            with open(self.path, 'wb') as writefile:
+                writefile.write(self.__npy_header(0))
+        elif value_fn.shape != self.__store_shape:
+            raise ValueError("All snapshots must have the shape %s" % str(self.__store_shape))
+
+        with open(self.path, 'r+b') as writefile:
+            writefile.seek(0, os.SEEK_END)
+            writefile.write(value_fn.astype(self.__store_dtype, copy=False).tobytes())
+            writefile.seek(0)
+            writefile.write(self.__npy_header(len(self.iterations)))
+
+    def __npy_header(self, num_snapshots):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % \
+                 (np.lib.format.dtype_to_descr(self.__store_dtype), (num_snapshots,) + tuple(self.__store_shape))
+        prefix = b'\x93NUMPY\x01\x00' + struct.pack('<H', self.NPY_HEADER_SIZE - 10)
+        return prefix + header.ljust(self.NPY_HEADER_SIZE - 11).encode('latin1') + b'\n'
+
+    def __len__(self):
+        return len(self.iterations)
+
+    def __getitem__(self, idx):
+        if self.mode == 'disk':
+            return self.load(self.path)[idx]
+        return self.__snapshots[idx]
+
+    def __iter__(self):
+        if self.mode == 'disk':
+            if self.__store_shape is not None:
+                for snapshot in self.load(self.path):
+                    yield snapshot
+        else:
+            for snapshot in self.__snapshots:
+                yield snapshot
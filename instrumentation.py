@@ -0,0 +1,104 @@
+import csv
+import json
+import time
+
+
+class SolverObserver(object):
+    """
+    Interface for objects which are notified by the solvers while they run. Observers are passed to the solvers with
+    the 'observers' argument and may override any of the methods below.
+    """
+    def on_start(self, solver):
+        """
+        Called before the first iteration.
+
+        :param solver: The solver instance
+        :return: None
+        """
+        pass
+
+    def on_iteration(self, solver, record):
+        """
+        Called after every iteration.
+
+        :param solver: The solver instance
+        :param record: Dict with the keys in 'IterationRecorder.FIELDS'. Quantities which the solver engine does not
+        measure separately are None.
+        :return: None
+        """
+        pass
+
+    def on_finish(self, solver):
+        """
+        Called once the solver has converged or has reached the maximum number of iterations.
+
+        :param solver: The solver instance
+        :return: None
+        """
+        pass
+
+
+class IterationRecorder(SolverObserver):
+    # 'max_residual' and 'mean_residual' are the maximum and mean absolute Bellman residual |TV - V| over all states.
+    # 'policy_changes' is the number of states whose greedy action changed during the iteration. The times are in
+    # seconds: 'transition_time' is spent looking up transitions and computing expectations over the successor states,
+    # 'evaluation_time' in the remaining backups or policy evaluation, and 'improvement_time' in computing the greedy
+    # policy. 'elapsed_time' is measured from the start of the solver.
+    FIELDS = ('iteration', 'max_residual', 'mean_residual', 'policy_changes', 'transition_time', 'evaluation_time',
+              'improvement_time', 'elapsed_time')
+
+    def __init__(self):
+        """
+        Ctor for an observer which records the statistics of every iteration of a solver, so that they can be exported
+        to JSON or CSV.
+        """
+        self.solver_name = None
+        self.parameters = dict()
+        self.records = list()
+        self.__start_time = None
+
+    def on_start(self, solver):
+        self.solver_name = type(solver).__name__
+        self.parameters = dict((name, getattr(solver, name)) for name in ('engine', 'evaluation', 'solver', 'stopping',
+                                                                          'discount_factor', 'eps', 'tol')
+                               if isinstance(getattr(solver, name, None), (str, int, float)))
+        self.parameters['num_states'] = solver.world.compile().num_states
+        self.records = list()
+        self.__start_time = time.perf_counter()
+
+    def on_iteration(self, solver, record):
+        record = dict((field, value.item() if hasattr(value, 'item') else value) for field, value in record.items())
+        record['elapsed_time'] = time.perf_counter() - self.__start_time
+        self.records.append(record)
+
+    def totals(self):
+        """
+        Sums up the time spent in every phase over all recorded iterations.
+        :return: Dict which maps 'transition_time', 'evaluation_time' and 'improvement_time' to seconds
+        """
+        return dict((field, sum(record[field] for record in self.records if record[field] is not None))
+                    for field in ('transition_time', 'evaluation_time', 'improvement_time'))
+
+    def to_json(self, filepath):
+        """
+        Writes the recorded iterations together with the solver parameters to a JSON file.
+
+        :param filepath: Full path to the output file
+        :return: None
+        """
+        with open(filepath, 'w') as writefile:
+            json.dump({'solver': self.solver_name, 'parameters': self.parameters, 'totals': self.totals(),
+                       'iterations': self.records}, writefile, indent=2)
+
+    def to_csv(self, filepath):
+        """
+        Writes the recorded iterations to a CSV file with one row per iteration. Missing values are left empty.
+
+        :param filepath: Full path to the output file
+        :return: None
+        """
+        with open(filepath, 'w', newline='') as writefile:
+            writer = csv.DictWriter(writefile, fieldnames=self.FIELDS)
+            writer.writeheader()
+            for record in self.records:
+                writer.writerow(record)
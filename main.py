@@ -1,4 +1,6 @@
+from cost_functions import one_step_cost_v1, one_step_cost_v2
 from policy_iteration import PolicyIteration
+from solution_cache import SolutionCache
 from value_iteration import ValueIteration
 from visualizer import Visualizer
 from world import World
@@ -10,31 +12,6 @@ import os
 
 np.set_printoptions(precision=2)
 
-# Two possible implementations for the one-step cost are provided
-
-
-def one_step_cost_v1(world, current_pos, next_pos):
-    # Reaching the goal yields -1 cost, falling into the trap yields a cost of 50, and all other transitions give
-    # zero cost.
-    if (next_pos == world.goal_pos).all():
-        return -1.
-    elif (next_pos == world.trap_pos).all():
-        return 50.
-    else:
-        return 0.
-
-
-def one_step_cost_v2(world, current_pos, next_pos):
-    # Reaching the goal yields -1 cost, falling into the trap yields a cost of 50, and all other transitions give
-    # a cost of 1.
-    if (current_pos == world.goal_pos).all() and (next_pos == world.goal_pos).all():
-        return 0.
-    elif (next_pos == world.trap_pos).all():
-        return 50.
-    else:
-        return 1.
-
-
 def main(args):
     # resolve path to world map definition
     if not args.world:
@@ -48,21 +25,37 @@ def main(args):
 
     world = World(world_map_path)
     visualizer = Visualizer(world)
+    cache = SolutionCache(args.cache_dir) if args.cache_dir else None
 
     # Value Iteration
-    value_iteration = ValueIteration(world, one_step_cost_v1, discount_factor=args.gamma, eps=10e-10)
+    value_iteration = ValueIteration(world, one_step_cost_v1, discount_factor=args.gamma, eps=10e-10,
+                                     precision='float64', cache=cache)
     value_iteration.execute()
     optimal_policy = value_iteration.extract_policy()
 
-    fig_vi = plt.figure()
-    visualizer.draw(fig_vi, optimal_policy, value_iteration.value_fn, "Value Iteration (gamma = %.2f)" % args.gamma)
-
     # Policy Iteration
-    policy_iteration = PolicyIteration(world, one_step_cost_v1, discount_factor=args.gamma)
+    policy_iteration = PolicyIteration(world, one_step_cost_v1, discount_factor=args.gamma, cache=cache)
     value_fn = policy_iteration.execute()
 
+    vi_title = "Value Iteration (gamma = %.2f)" % args.gamma
+    pi_title = "Policy Iteration (gamma = %.2f)" % args.gamma
+
+    if args.output_dir:
+        # headless: write the plots to image files instead of showing them
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+        visualizer.render(os.path.join(args.output_dir, 'value_iteration.png'), value_iteration.value_fn,
+                          optimal_policy, vi_title)
+        visualizer.render(os.path.join(args.output_dir, 'policy_iteration.png'), value_fn, policy_iteration.policy,
+                          pi_title)
+        print("Plots written to %s" % args.output_dir)
+        return
+
+    fig_vi = plt.figure()
+    visualizer.draw(fig_vi, optimal_policy, value_iteration.value_fn, vi_title)
+
     fig_pi = plt.figure()
-    visualizer.draw(fig_pi, policy_iteration.policy, value_fn, "Policy Iteration (gamma = %.2f)" % args.gamma)
+    visualizer.draw(fig_pi, policy_iteration.policy, value_fn, pi_title)
 
     plt.show()
 
@@ -71,4 +64,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--world', '-w', required=False)
     parser.add_argument('--gamma', type=float, default=0.9)
+    parser.add_argument('--output-dir', '-o', required=False,
+                        help="Directory to which the plots are written as PNG files instead of being shown")
+    parser.add_argument('--cache-dir', required=False,
+                        help="Directory in which solutions are cached, so that repeated runs need not solve again")
     main(parser.parse_args())
@@ -0,0 +1,128 @@
+from cost_functions import as_batched
+from transition_model import TransitionModel
+from world import World
+
+import numpy as np
+
+
+def world_with_goal(world, goal_pos):
+    """
+    Creates a copy of the world with a different goal cell. The copy shares the occupancy grid and the compiled
+    transition arrays of the original world, since neither depends on the goal, but has its own cache of one-step costs.
+
+    :param world: Instance of class 'World'
+    :param goal_pos: (x, y) position of the new goal cell
+    :return: Instance of class 'World'
+    """
+    goal_world = World()
+    goal_world.set_grid(world.map, world.start_pos, goal_pos, world.trap_pos)
+    model = world.compile()
+    goal_world.attach_model(TransitionModel.from_arrays(dict((name, getattr(model, name)) for name in model.ARRAYS),
+                                                        model.action_stochasticity))
+    return goal_world
+
+
+class MultiGoalValueIteration(object):
+    def __init__(self, world, one_step_cost_fn, goals, discount_factor=0.9, eps=10e-4, batch_size=64):
+        """
+        Ctor for value iteration towards many goal cells at once, e.g. to build a navigation table for all destinations
+        of a world. All goals share the compiled transition model, and every sweep applies the Bellman operator to the
+        value functions of a whole batch of goals with a single sparse matrix product.
+
+        :param world: Instance of class 'World'. Its own goal cell is ignored.
+        :param one_step_cost_fn: Method that returns the one step cost given an instance of World, the current position
+        and the next position. May also be a batched cost function, see 'cost_functions'. It is evaluated once per goal
+        on a copy of the world whose goal cell is set accordingly.
+        :param goals: List of (x, y) goal positions, each of which must be a free cell
+        :param discount_factor: In range [0, 1)
+        :param eps: Threshold for value function convergence, applied to every goal separately
+        :param batch_size: Number of goals which are solved together. Bounds the memory used for the per-goal costs,
+        values and Q-values.
+        """
+        self.world = world
+        self.one_step_cost_fn = one_step_cost_fn
+        self.goals = np.array(goals, np.int32).reshape(-1, 2)
+        self.discount_factor = discount_factor
+        self.eps = eps
+        self.batch_size = batch_size
+
+        model = self.world.compile()
+        for goal in self.goals:
+            if not self.world.is_within_bounds(goal) or model.state_index[goal[1], goal[0]] == -1:
+                raise ValueError("Goal (%d, %d) is not a free cell of the world" % (goal[0], goal[1]))
+
+        self.value_fns = np.zeros((len(self.goals),) + self.world.map.shape, np.float32)
+        self.policies = np.zeros((len(self.goals),) + self.world.map.shape + (2,), np.float32)
+        self.iterations = np.zeros(len(self.goals), np.int64)
+
+    def execute(self, max_iterations=int(10e6)):
+        """
+        Runs value iteration for all goals.
+
+        :param max_iterations: Maximum allowable number of iterations per goal
+        :return: Stacked value functions of shape [num_goals, H, W]. The corresponding greedy policies are stored in
+        'policies', of shape [num_goals, H, W, 2].
+        """
+        model = self.world.compile()
+        transition_matrix = model.transition_matrix()
+
+        for start in range(0, len(self.goals), self.batch_size):
+            goal_idxs = np.arange(start, min(start + self.batch_size, len(self.goals)))
+            expected_costs = self.expected_costs(goal_idxs)
+            values = np.zeros((model.num_states, len(goal_idxs)), np.float64)
+
+            # goals drop out of the batch as soon as their value function has converged. The costs and values of the
+            # remaining goals are only gathered into new arrays when that happens.
+            active = np.arange(len(goal_idxs))
+            active_costs, active_values = expected_costs, np.copy(values)
+            for k in range(max_iterations):
+                new_values = self.__q_values(transition_matrix, active_costs, active_values).min(axis=1)
+                max_change = np.max(np.absolute(new_values - active_values), axis=0)
+                active_values = new_values
+                self.iterations[goal_idxs[active]] = k + 1
+
+                has_converged = max_change <= self.eps
+                if has_converged.any() or k + 1 == max_iterations:
+                    values[:, active] = active_values
+                    active = active[~has_converged]
+                    active_costs, active_values = active_costs[:, ~has_converged], active_values[:, ~has_converged]
+                if len(active) == 0:
+                    break
+
+            q = self.__q_values(transition_matrix, expected_costs, values)
+            self.value_fns[goal_idxs] = np.moveaxis(model.to_grid(values, np.float32), 2, 0)
+            self.policies[goal_idxs] = np.moveaxis(model.indices_to_policy(np.argmin(q, axis=1), np.float32), 2, 0)
+
+        print("Multi-goal value iteration has converged for %d of %d goals after at most %d iterations" %
+              (np.sum(self.iterations < max_iterations), len(self.goals), self.iterations.max(initial=0)))
+        return self.value_fns
+
+    def __q_values(self, transition_matrix, expected_costs, values):
+        # Q-values of every (state, action) pair for a batch of goals, of shape [num_states, num_actions, batch size].
+        # Actions which are not allowed have no transitions and infinite expected cost, so they need no masking.
+        q = transition_matrix @ values
+        q *= self.discount_factor
+        q += expected_costs
+        return q.reshape(values.shape[0], -1, values.shape[1])
+
+    def expected_costs(self, goal_idxs):
+        """
+        Returns the expected one-step cost of every (state, action) pair for the given goals.
+
+        :param goal_idxs: Indices into 'goals'
+        :return: Array of shape [num_states * num_actions, len(goal_idxs)]. Actions which are not allowed have infinite
+        cost.
+        """
+        model = self.world.compile()
+        one_step_cost_fn = as_batched(self.one_step_cost_fn)
+        current_positions = model.states[model.rows // model.num_actions]
+        next_positions = model.states[model.next_states]
+
+        expected_costs = np.zeros((model.num_pairs, len(goal_idxs)), np.float64)
+        for j, goal_idx in enumerate(goal_idxs):
+            costs = one_step_cost_fn(world_with_goal(self.world, self.goals[goal_idx]), current_positions,
+                                     next_positions)
+            expected_costs[:, j] = np.bincount(model.rows, model.probs * costs, minlength=model.num_pairs)
+
+        expected_costs[~model.action_mask.reshape(-1)] = np.inf
+        return expected_costs
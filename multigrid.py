@@ -0,0 +1,213 @@
+from cost_functions import as_batched, transition_costs
+from world import World
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+class ScaledCost(object):
+    def __init__(self, one_step_cost_fn, scale):
+        """
+        Batched one-step cost function which scales the costs of another one, e.g. so that a single step on a coarse
+        grid costs as much as the several steps on the fine grid which it stands for.
+
+        :param one_step_cost_fn: Scalar or batched one-step cost function
+        :param scale: Factor by which the costs are multiplied
+        """
+        self.one_step_cost_fn = as_batched(one_step_cost_fn)
+        self.scale = scale
+        self.is_batched = True
+
+    def __call__(self, world, current_positions, next_positions):
+        return self.scale * np.asarray(self.one_step_cost_fn(world, current_positions, next_positions), np.float64)
+
+
+def coarsen_world(world, factor=2):
+    """
+    Downsamples the occupancy grid of a world by merging blocks of factor x factor cells. A block becomes a free cell if
+    at least half of its cells are free, so that corridors of width factor / 2 survive. The cells which contain the
+    start, goal and trap positions are always free.
+
+    :param world: Instance of class 'World'
+    :param factor: Side length of the merged blocks
+    :return: Instance of class 'World' of size ceil(H / factor) x ceil(W / factor)
+    """
+    height, width = world.map.shape
+    coarse_height, coarse_width = -(-height // factor), -(-width // factor)
+
+    # pad with walls to a multiple of the block size, then count the free cells of every block
+    free = np.zeros((coarse_height * factor, coarse_width * factor), np.int32)
+    free[:height, :width] = world.map != world.WALL_CELL
+    free_counts = free.reshape(coarse_height, factor, coarse_width, factor).sum(axis=(1, 3))
+
+    occupancy = np.where(2 * free_counts >= factor * factor, world.FREE_CELL, world.WALL_CELL).astype(np.uint8)
+
+    def coarse_pos(pos):
+        if not world.is_within_bounds(pos):
+            return -1, -1
+        occupancy[pos[1] // factor, pos[0] // factor] = world.FREE_CELL
+        return pos[0] // factor, pos[1] // factor
+
+    coarse_world = World()
+    coarse_world.set_grid(occupancy, coarse_pos(world.start_pos), coarse_pos(world.goal_pos),
+                          coarse_pos(world.trap_pos))
+    coarse_world.action_stochasticity = world.action_stochasticity
+    return coarse_world
+
+
+def prolong(coarse_value_fn, coarse_world, world, factor=2):
+    """
+    Transfers a value function from a coarsened world to the original one. Every cell takes the value of the block that
+    contains it. Blocks which are walls on the coarse grid take the mean of their free neighbours, so that the values of
+    free cells inside them remain sensible.
+
+    :param coarse_value_fn: Value function of 'coarse_world' as a 2D array
+    :param coarse_world: Instance of class 'World' as returned by 'coarsen_world'
+    :param world: The original world
+    :param factor: Factor by which 'coarse_world' was downsampled
+    :return: Value function of 'world' as a 2D float64 array which is zero at walls
+    """
+    values = np.where(coarse_world.wall_mask, np.nan, coarse_value_fn).astype(np.float64)
+
+    # fill the coarse walls from their neighbours, growing the filled region by one block per pass. A few passes
+    # suffice, since fine free cells only lie within walls that are thin on the coarse grid.
+    for _ in range(3):
+        missing = np.isnan(values)
+        if not missing.any():
+            break
+        padded = np.pad(values, 1, constant_values=np.nan)
+        neighbours = np.stack([padded[1 + dy:1 + dy + values.shape[0], 1 + dx:1 + dx + values.shape[1]]
+                               for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+        counts = np.sum(~np.isnan(neighbours), axis=0)
+        sums = np.nansum(neighbours, axis=0)
+        fill = missing & (counts > 0)
+        values[fill] = sums[fill] / counts[fill]
+
+    values[np.isnan(values)] = 0.
+    fine_values = np.repeat(np.repeat(values, factor, axis=0), factor, axis=1)[:world.world_height, :world.world_width]
+    return np.where(world.wall_mask, 0., fine_values)
+
+
+def prolong_policy(coarse_policy, world, q_values, factor=2):
+    """
+    Transfers a policy from a coarsened world to the original one. Every free cell takes the action of the block that
+    contains it. Cells for which that action is not allowed or idles, e.g. within the block of the goal or within
+    blocks which are walls on the coarse grid, take the greedy action with respect to 'q_values' instead.
+
+    :param coarse_policy: Policy of the coarsened world as an array of shape [h, w, 2]
+    :param world: The original world
+    :param q_values: Q-values of the original world of shape [num_states, num_actions], which are infinite for actions
+    that are not allowed
+    :param factor: Factor by which the coarse world was downsampled
+    :return: Action indices of the original world of shape [num_states]
+    """
+    model = world.compile()
+    displacements = np.repeat(np.repeat(coarse_policy, factor, axis=0), factor, axis=1)
+    displacements = model.to_flat(displacements[:world.world_height, :world.world_width])
+
+    matches = (displacements[:, None, :] == model.actions[None, :, :]).all(axis=2)
+    coarse_actions = np.argmax(matches, axis=1)
+    usable = matches.any(axis=1) & model.action_mask[np.arange(model.num_states), coarse_actions] & \
+        model.actions[coarse_actions].any(axis=1)
+
+    return np.where(usable, coarse_actions, np.argmin(q_values, axis=1))
+
+
+def evaluate_policy(world, one_step_cost_fn, discount_factor, policy_actions):
+    """
+    Computes the exact value of a policy by solving its sparse linear system.
+
+    :param world: Instance of class 'World'
+    :param one_step_cost_fn: Scalar or batched one-step cost function
+    :param discount_factor: In range [0, 1)
+    :param policy_actions: Action indices of shape [num_states]
+    :return: Value function as a 2D float64 array
+    """
+    model = world.compile()
+    state_idxs, next_state_idxs, probs, selected = model.policy_transitions(policy_actions)
+
+    P = scipy.sparse.csr_matrix((probs, (state_idxs, next_state_idxs)), shape=(model.num_states, model.num_states))
+    A = scipy.sparse.identity(model.num_states, format='csc') - discount_factor * P
+    b = np.bincount(state_idxs, probs * transition_costs(world, one_step_cost_fn)[selected],
+                    minlength=model.num_states)
+    return model.to_grid(scipy.sparse.linalg.spsolve(A.tocsc(), b), np.float64)
+
+
+def solve_level(world, one_step_cost_fn, discount_factor, eps, initial_value_fn=None, max_iterations=int(10e6)):
+    """
+    Runs synchronous value iteration on a single level until no value changes by more than 'eps'.
+
+    :param world: Instance of class 'World'
+    :param one_step_cost_fn: Scalar or batched one-step cost function
+    :param discount_factor: In range [0, 1)
+    :param eps: Convergence threshold
+    :param initial_value_fn: Initial value function as a 2D array, or None to start from zero
+    :param max_iterations: Maximum allowable number of iterations
+    :return: Tuple of (value function as a 2D float64 array, number of iterations)
+    """
+    model = world.compile()
+    transition_matrix = model.transition_matrix()
+    expected_costs = model.expected_costs(transition_costs(world, one_step_cost_fn))
+    expected_costs[~model.action_mask] = np.inf
+    expected_costs = expected_costs.reshape(-1)
+
+    values = np.zeros(model.num_states) if initial_value_fn is None else \
+        model.to_flat(initial_value_fn).astype(np.float64)
+
+    for k in range(max_iterations):
+        q = expected_costs + discount_factor * (transition_matrix @ values)
+        new_values = q.reshape(model.num_states, model.num_actions).min(axis=1)
+        max_change = np.max(np.absolute(new_values - values), initial=0.)
+        values = new_values
+        if max_change <= eps:
+            return model.to_grid(values, np.float64), k + 1
+
+    return model.to_grid(values, np.float64), max_iterations
+
+
+def multigrid_warm_start(world, one_step_cost_fn, discount_factor, eps, min_size=32):
+    """
+    Computes an initial value function and policy for a world by solving successively finer versions of it, starting
+    from the coarsest one whose longer side is at most 'min_size' cells. On a grid which is coarsened by a total factor
+    f, one step stands for f steps of the original world, so it is discounted by gamma^f and its cost is scaled by the
+    sum of the discounts of the f original steps.
+
+    The policy of every level is prolonged to the next finer one and evaluated exactly there. Prolonging the values
+    alone is not enough: their errors close to the goal travel through the whole world again, so value iteration
+    would need as many sweeps as from scratch. The value of the prolonged policy instead is consistent everywhere and,
+    being the value of an actual policy, an upper bound on the optimal value function. It warm-starts value iteration
+    on the next level, except on the original world, which is not solved.
+
+    :param world: Instance of class 'World'
+    :param one_step_cost_fn: Scalar or batched one-step cost function
+    :param discount_factor: In range [0, 1)
+    :param eps: Convergence threshold of value iteration on the coarse levels
+    :param min_size: Maximum size of the coarsest level
+    :return: Tuple of (value function of 'world' as a 2D float64 array, action indices of shape [num_states]), or None
+    if the world is too small to be coarsened
+    """
+    levels = [world]
+    while max(levels[-1].map.shape) > min_size:
+        levels.append(coarsen_world(levels[-1]))
+    if len(levels) == 1:
+        return None
+
+    value_fn, policy = None, None
+    for level in range(len(levels) - 1, -1, -1):
+        factor = 2 ** level
+        gamma = discount_factor ** factor
+        cost_fn = ScaledCost(one_step_cost_fn, (1. - gamma) / (1. - discount_factor)) if level else one_step_cost_fn
+        model = levels[level].compile()
+        expected_costs = model.expected_costs(transition_costs(levels[level], cost_fn))
+
+        if policy is not None:
+            values = model.to_flat(prolong(value_fn, levels[level + 1], levels[level]))
+            policy_actions = prolong_policy(policy, levels[level], model.q_values(expected_costs, values, gamma))
+            value_fn = evaluate_policy(levels[level], cost_fn, gamma, policy_actions)
+            if level == 0:
+                return value_fn, policy_actions
+
+        value_fn, _ = solve_level(levels[level], cost_fn, gamma, eps, value_fn)
+        q = model.q_values(expected_costs, model.to_flat(value_fn), gamma)
+        policy = model.indices_to_policy(np.argmin(q, axis=1), np.int32)
@@ -1,22 +1,91 @@
+from cost_functions import transition_costs
+from history import ValueFnHistory
+from multigrid import multigrid_warm_start
+
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import time
 
 
 class PolicyIteration(object):
-    def __init__(self, world, one_step_cost_fn, discount_factor=0.9):
+    ENGINES     = ('loop', 'vectorized')
+    EVALUATIONS = ('dense', 'sparse', 'modified')
+    SOLVERS     = ('direct', 'gmres', 'bicgstab', 'jacobi')
+
+    def __init__(self, world, one_step_cost_fn, discount_factor=0.9, engine='loop', evaluation='dense',
+                 solver='direct', tol=10e-10, max_solver_iterations=10000, sweeps=20,
+                 history=None, observers=None, cache=None, multigrid=False):
         """
         Ctor for policy iteration algorithm implementation.
 
         :param world: Instance of class 'World'
-        :param one_step_cost_fn: Method that returns the one step cost given an instance of World, the current position.
-        and the next position
+        :param one_step_cost_fn: Method that returns the one step cost given an instance of World, the current position
+        and the next position. May also be a batched cost function, see 'cost_functions'.
         :param discount_factor: In range [0, 1)
+        :param engine: 'loop' improves the policy one state and action at a time. 'vectorized' improves all states at
+        once using the compiled transition model.
+        :param evaluation: 'dense' solves the linear system of the policy with a dense matrix. 'sparse' assembles a
+        sparse matrix over the free states only and solves it with 'solver'. 'modified' only approximates the value of
+        the policy by applying its Bellman operator 'sweeps' times, starting from the values of the previous iteration
+        (modified policy iteration).
+        :param solver: Solver used for sparse evaluation: 'direct' (sparse LU factorization), 'gmres', 'bicgstab' or
+        'jacobi'. The iterative solvers are warm-started from the value function of the previous iteration.
+        :param tol: Convergence tolerance of the iterative solvers. For modified evaluation, the iteration terminates once
+        the policy is stable and the last evaluation sweep changed no value by more than 'tol'.
+        :param max_solver_iterations: Maximum number of iterations of the iterative solvers and maximum number of
+        sweeps per adaptive modified evaluation
+        :param sweeps: Number of evaluation sweeps per iteration for modified evaluation, or 'adaptive' to sweep until
+        the change in values has dropped to a tenth of that of the first sweep
+        :param history: Instance of class 'ValueFnHistory' which records the value function of every iteration. By
+        default, all iterations are kept in memory.
+        :param observers: List of 'instrumentation.SolverObserver' instances which are notified after every iteration
+        :param cache: Instance of class 'SolutionCache'. If it holds a solution for the same world, cost function,
+        discount factor, evaluation and tolerance, 'execute' loads it instead of iterating. Otherwise, it starts from
+        the cached policy with the closest discount factor, if any, and stores the result.
+        :param multigrid: If True, 'execute' starts from a policy which is obtained by solving successively finer
+        coarsened versions of the world, see 'multigrid.multigrid_warm_start', instead of an arbitrary one. The
+        coarse levels are solved to 'tol'. Ignored if the cache provides a warm start.
         """
+        if engine not in self.ENGINES:
+            raise ValueError("Unknown engine '%s'. Must be one of %s" % (engine, ', '.join(self.ENGINES)))
+        if evaluation not in self.EVALUATIONS:
+            raise ValueError("Unknown evaluation '%s'. Must be one of %s" % (evaluation, ', '.join(self.EVALUATIONS)))
+        if solver not in self.SOLVERS:
+            raise ValueError("Unknown solver '%s'. Must be one of %s" % (solver, ', '.join(self.SOLVERS)))
+
         self.world = world
         self.discount_factor = discount_factor
-        self.one_step_cost_fn = lambda current_pos, next_pos: one_step_cost_fn(self.world, current_pos, next_pos)
-        self.policy = None
-
-        self.value_fn_history = list()
+        self.engine = engine
+        self.evaluation = evaluation
+        self.solver = solver
+        self.tol = tol
+        self.max_solver_iterations = max_solver_iterations
+        self.sweeps = sweeps
+        self.one_step_cost_fn = one_step_cost_fn
+        self.observers = list(observers) if observers else list()
+        self.cache = cache
+        self.multigrid = multigrid
+
+        self.value_fn_history = history if history is not None else ValueFnHistory()
+
+        self.iterations = 0
+        self.evaluation_sweeps = 0
+        self.sweeps_per_iteration = list()
+        self.evaluation_residual = np.inf
+
+        # the policy is stored as the index of the action of every free state of '__policy_model'. 'changed_states'
+        # marks the states whose action was changed by the last improvement, or is None if all states are new.
+        self.policy_actions = None
+        self.changed_states = None
+        self.__policy_model = None
+        self.__policy_grid = None
+        self.__dense_system = None
+
+        self.__values = None
+        self.__value_fn = None
+        self.__solved_model = None
+        self.__transition_time = 0.
 
     def init_random_policy(self):
         """
@@ -24,123 +93,233 @@ class PolicyIteration(object):
         :return: Correctly initialized policy
         """
 
-        policy = np.zeros((self.world.world_height, self.world.world_width, 2), np.int32)
-        for y in range(self.world.world_height):
-            for x in range(self.world.world_width):
-                state = np.array([x, y], np.int32)
-                if self.world.is_wall(state):
-                    continue
+        model = self.world.compile()
 
-                # iterate through list of actions and set the policy to the first permitted action
-                for action in self.world.actions:
-                    if self.world.is_action_allowed(state, action):
-                        policy[y, x] = action
-                        break
-        return policy
+        # set the policy of every state to the first permitted action in the list of actions
+        first_allowed_action = np.argmax(model.action_mask, axis=1)
+        return model.indices_to_policy(first_allowed_action, np.int32)
 
     def has_policy_changed(self, policy):
         return not np.allclose(self.policy, policy, atol=10e-8)
 
+    def set_policy_actions(self, policy_actions, changed_states=None):
+        """
+        Sets the policy from per-state action indices of the compiled transition model.
+
+        :param policy_actions: Integer array of shape [num_states]
+        :param changed_states: Boolean mask of shape [num_states] of the states whose action differs from the current
+        policy, or None if unknown
+        :return: None
+        """
+        self.policy_actions = np.asarray(policy_actions, np.uint8)
+        self.changed_states = changed_states
+        self.__policy_model = self.world.compile()
+        self.__policy_grid = None
+
+    def __current_model(self):
+        # returns the compiled model, converting the policy if it refers to the states of a previously compiled one
+        model = self.world.compile()
+        if model is not self.__policy_model:
+            self.set_policy_actions(model.policy_to_indices(self.policy))
+        return model
+
+    def __get_policy(self):
+        # the vector form is only built on demand, with a single lookup of the displacement of every action
+        if self.policy_actions is None:
+            return None
+        if self.__policy_grid is None:
+            self.__policy_grid = self.__policy_model.indices_to_policy(self.policy_actions, np.int32)
+        return self.__policy_grid
+
+    def __set_policy(self, policy):
+        if policy is None:
+            self.policy_actions = None
+            self.__policy_grid = None
+            return
+        self.set_policy_actions(self.world.compile().policy_to_indices(policy))
+
     def evaluate(self):
         """
         Evaluates the current policy using a linear system of equations
         :return: Cost of the current policy
         """
-
-        A = np.zeros((self.state_cardinality, self.state_cardinality), np.float32)
-        b = np.zeros(self.state_cardinality, np.float32)
-
-        next_free_idx = 0
-        idx_mapping = list()
-
-        def mapping_exists(state_to_find):
-            for i, s in enumerate(idx_mapping):
-                if np.array_equal(s, state_to_find):
-                    return i
-            return -1
-
-        for y in range(self.world.world_height):
-            for x in range(self.world.world_width):
-                state = np.array([x, y], np.int32)
-                if self.world.is_wall(state):
-                    continue
-
-                # check if idx mapping for next_state already exists
-                retrieved_idx = mapping_exists(state)
-                if retrieved_idx != -1:
-                    state_idx = retrieved_idx
-                else:
-                    state_idx = next_free_idx
-                    idx_mapping.append(state)
-                    next_free_idx += 1
-
-                action = self.policy[y, x]
-                transitions = self.world.get_transitions(state, action)
-                assert transitions  # non-empty
-                A[state_idx, state_idx] = 1.
-
-                for next_state, transition_prob in transitions:
-                    # check if idx mapping for next_state already exists
-                    retrieved_idx = mapping_exists(next_state)
-                    if retrieved_idx != -1:
-                        next_state_idx = retrieved_idx
-                    else:
-                        next_state_idx = next_free_idx
-                        idx_mapping.append(next_state)
-                        next_free_idx += 1
-
-                    b[state_idx] += transition_prob * self.one_step_cost_fn(state, next_state)
-                    A[state_idx, next_state_idx] -= transition_prob * self.discount_factor
-
-        # clip A and b
-        A = A[:next_free_idx, :next_free_idx]
-        b = b[:next_free_idx]
+        if self.evaluation == 'sparse':
+            return self.__evaluate_sparse()
+        elif self.evaluation == 'modified':
+            return self.__evaluate_modified()
+
+        model = self.__current_model()
+        policy_actions = self.policy_actions
+        one_step_costs = self.transition_costs()
+
+        # The system of the previous evaluation is kept, and only the rows of the states whose action has changed since
+        # are assembled again. Late iterations typically change very few states.
+        system = self.__dense_system
+        if system is None or system[0] is not model or system[1] is not one_step_costs or \
+                system[2] != self.discount_factor or self.changed_states is None:
+            A = np.zeros((model.num_states, model.num_states), np.float32)
+            b = np.zeros(model.num_states, np.float32)
+            self.__dense_system = (model, one_step_costs, self.discount_factor, A, b)
+            updated_states = range(model.num_states)
+        else:
+            A, b = system[3:]
+            updated_states = np.flatnonzero(self.changed_states)
+
+        # assembling the system from the transitions of every state counts as transition lookup
+        start_time = time.perf_counter()
+        for state_idx in updated_states:
+            next_states, probs = model.transitions(state_idx, policy_actions[state_idx])
+            costs = one_step_costs[model.transition_slice(state_idx, policy_actions[state_idx])]
+            assert len(next_states) > 0  # non-empty
+            A[state_idx] = 0.
+            A[state_idx, state_idx] = 1.
+            b[state_idx] = 0.
+
+            for next_state_idx, transition_prob, cost in zip(next_states, probs, costs):
+                b[state_idx] += transition_prob * cost
+                A[state_idx, next_state_idx] -= transition_prob * self.discount_factor
+        self.__transition_time += time.perf_counter() - start_time
 
         # solve the linear system
         solution = np.linalg.solve(A, b)
 
         # convert the flattened state vector back into a 2D array corresponding to the world map
-        value_fn = np.zeros(self.world.map.shape, np.float32)
-        for i, (x, y) in enumerate(idx_mapping):
-            value_fn[y, x] = solution[i]
+        value_fn = model.to_grid(solution, np.float32)
+
+        self.value_fn_history.append(value_fn)
+        return value_fn
+
+    def __evaluate_sparse(self):
+        model = self.__current_model()
+        policy_actions = self.policy_actions
+        start_time = time.perf_counter()
+        state_idxs, next_state_idxs, probs, selected = model.policy_transitions(policy_actions)
+        self.__transition_time += time.perf_counter() - start_time
+
+        # A = I - gamma * P, where P is the transition matrix of the current policy
+        P = scipy.sparse.csr_matrix((probs, (state_idxs, next_state_idxs)), shape=(model.num_states, model.num_states))
+        A = (scipy.sparse.identity(model.num_states, format='csr') - self.discount_factor * P).tocsr()
+        b = np.bincount(state_idxs, probs * self.transition_costs()[selected], minlength=model.num_states)
+
+        # warm-start from the solution of the previous iteration
+        x0 = self.__values if self.__values is not None and self.__values.shape == b.shape else np.zeros_like(b)
+
+        if self.solver == 'direct':
+            solution = scipy.sparse.linalg.spsolve(A.tocsc(), b)
+        elif self.solver == 'jacobi':
+            diagonal = A.diagonal()
+            off_diagonal = A - scipy.sparse.diags(diagonal)
+            solution = x0
+            for _ in range(self.max_solver_iterations):
+                prev_solution = solution
+                solution = (b - off_diagonal.dot(prev_solution)) / diagonal
+                if np.max(np.absolute(solution - prev_solution)) <= self.tol:
+                    break
+            else:
+                print("WARNING: jacobi did not converge during policy evaluation")
+        elif np.linalg.norm(b - A.dot(x0)) <= self.tol * np.linalg.norm(b):
+            # the warm start already solves the system, which happens once the policy stops changing
+            solution = x0
+        else:
+            iterative_solver = scipy.sparse.linalg.gmres if self.solver == 'gmres' else scipy.sparse.linalg.bicgstab
+            solution, info = iterative_solver(A, b, x0=x0, rtol=self.tol, atol=0., maxiter=self.max_solver_iterations)
+            if info > 0:
+                print("WARNING: %s did not converge during policy evaluation after %d iterations" % (self.solver, info))
+            elif info < 0:
+                # breakdown, which bicgstab is prone to when the residual is supported on only a few states
+                print("WARNING: %s broke down during policy evaluation, falling back to the direct solver" %
+                      self.solver)
+                solution = scipy.sparse.linalg.spsolve(A.tocsc(), b)
+
+        self.__values = solution
+
+        value_fn = model.to_grid(solution, np.float32)
+        self.value_fn_history.append(value_fn)
+        return value_fn
+
+    def __evaluate_modified(self):
+        model = self.__current_model()
+        policy_actions = self.policy_actions
+        start_time = time.perf_counter()
+        state_idxs, next_state_idxs, probs, selected = model.policy_transitions(policy_actions)
+        self.__transition_time += time.perf_counter() - start_time
+        b = np.bincount(state_idxs, probs * self.transition_costs()[selected], minlength=model.num_states)
+
+        values = self.__values if self.__values is not None and self.__values.shape == b.shape else np.zeros_like(b)
+        max_sweeps = self.max_solver_iterations if self.sweeps == 'adaptive' else self.sweeps
+
+        first_residual = None
+        for sweep in range(max_sweeps):
+            prev_values = values
+            values = b + self.discount_factor * np.bincount(state_idxs, probs * prev_values[next_state_idxs],
+                                                            minlength=model.num_states)
+
+            self.evaluation_residual = np.max(np.absolute(values - prev_values))
+            if first_residual is None:
+                first_residual = self.evaluation_residual
+
+            if self.evaluation_residual <= self.tol:
+                break
+            if self.sweeps == 'adaptive' and self.evaluation_residual <= 0.1 * first_residual:
+                break
+
+        self.__values = values
+        self.evaluation_sweeps += sweep + 1
+        self.sweeps_per_iteration.append(sweep + 1)
 
+        value_fn = model.to_grid(values, np.float32)
         self.value_fn_history.append(value_fn)
         return value_fn
 
+    def transition_costs(self):
+        """
+        Returns the one-step cost of every transition of the compiled transition model. The cost function is evaluated
+        only once per transition, see 'cost_functions.transition_costs'.
+        :return: Array of shape [num_transitions]
+        """
+        return transition_costs(self.world, self.one_step_cost_fn)
+
     def improve(self, value_fn):
         """
         Performs a single policy improvement step given the value function of the current policy.
         :param value_fn: Value of the current policy (as computed by the 'evaluate' method
-        :return: None
+        :return: Boolean mask of shape [num_states] of the states whose action has changed, also stored in
+        'changed_states'
         """
 
-        for y in range(self.world.world_height):
-            for x in range(self.world.world_width):
-                state = np.array([x, y], np.int32)
-                if self.world.is_wall(state):
-                    continue
+        model = self.__current_model()
+        one_step_costs = self.transition_costs()
+        values = model.to_flat(value_fn)
+
+        if self.engine == 'vectorized':
+            q = model.q_values(model.expected_costs(one_step_costs), values, self.discount_factor)
+            policy_actions = np.argmin(q, axis=1)
+            self.set_policy_actions(policy_actions, policy_actions != self.policy_actions)
+            return self.changed_states
 
-                min_cost = 10e6
-                min_cost_action = None
+        policy_actions = np.copy(self.policy_actions)
+        for s, state in enumerate(model.states):
+            min_cost = 10e6
+            min_cost_action = None
 
-                for action in self.world.actions:
-                    if not self.world.is_action_allowed(state, action):
-                        continue
+            for a in np.flatnonzero(model.action_mask[s]):
+                next_states, probs = model.transitions(s, a)
+                costs = one_step_costs[model.transition_slice(s, a)]
 
-                    transitions = self.world.get_transitions(state, action)
+                cost_fn = sum([transition_prob * (cost + (self.discount_factor * values[next_state]))
+                               for next_state, transition_prob, cost in zip(next_states, probs, costs)])
 
-                    cost_fn = sum([transition_prob * (self.one_step_cost_fn(state, next_state) +
-                                                      (self.discount_factor * value_fn[next_state[1], next_state[0]]))
-                                   for next_state, transition_prob in transitions])
+                if cost_fn < min_cost:
+                    min_cost = cost_fn
+                    min_cost_action = a
 
-                    if cost_fn < min_cost:
-                        min_cost = cost_fn
-                        min_cost_action = action
+            if min_cost_action is None:
+                raise ValueError("No feasible action found for state (%d, %d)" % (state[0], state[1]))
 
-                if min_cost_action is None:
-                    raise ValueError("No feasible action found for state (%d, %d)" % (x, y))
+            policy_actions[s] = min_cost_action
 
-                self.policy[y, x] = min_cost_action
+        self.set_policy_actions(policy_actions, policy_actions != self.policy_actions)
+        return self.changed_states
 
     def execute(self, max_iterations=int(10e6)):
         """
@@ -149,27 +328,154 @@ class PolicyIteration(object):
         :return: The value function of the policy at the last iteration
         """
 
-        self.policy = self.init_random_policy()
+        if self.cache is None:
+            self.__init_policy()
+            return self.__iterate(max_iterations)
+
+        model = self.world.compile()
+        cache_key = self.cache.key(self.world, self.one_step_cost_fn, {
+            'solver': type(self).__name__, 'discount_factor': self.discount_factor, 'evaluation': self.evaluation,
+            'tol': self.tol})
+
+        entry = self.cache.get(cache_key)
+        if entry is not None and entry['value_fn'].shape == self.world.map.shape:
+            print("Loaded the cached solution")
+            for observer in self.observers:
+                observer.on_start(self)
+            self.policy = entry['policy'].astype(np.int32)
+            self.iterations = 0
+            self.__value_fn = entry['value_fn'].astype(np.float32)
+            self.__values = model.to_flat(self.__value_fn).astype(np.float64)
+            self.__solved_model = model
+            self.value_fn_history.append(self.__value_fn)
+            for observer in self.observers:
+                observer.on_finish(self)
+            return self.__value_fn
+
+        # the optimal policy rarely changes much with the discount factor, so a nearby one is a good initial policy
+        warm_start = self.cache.nearest(cache_key, self.discount_factor)
+        if warm_start is not None and warm_start['value_fn'].shape == self.world.map.shape:
+            print("Warm-starting from the cached solution for gamma = %g" % warm_start['discount_factor'])
+            self.policy = warm_start['policy'].astype(np.int32)
+            self.__values = model.to_flat(warm_start['value_fn']).astype(np.float64)
+        else:
+            self.__init_policy()
+
+        value_fn = self.__iterate(max_iterations)
+        if self.iterations < max_iterations:
+            self.cache.put(cache_key, value_fn, self.policy, self.discount_factor)
+        return value_fn
+
+    def __init_policy(self):
+        # the multigrid policy comes with its exact value, from which the iterative evaluations start
+        warm_start = None
+        if self.multigrid:
+            warm_start = multigrid_warm_start(self.world, self.one_step_cost_fn, self.discount_factor, self.tol)
+
+        if warm_start is None:
+            self.policy = self.init_random_policy()
+            return
+
+        print("Starting from the multigrid policy")
+        self.set_policy_actions(warm_start[1])
+        self.__values = self.world.compile().to_flat(warm_start[0])
+
+    def resolve(self, max_iterations=int(10e6)):
+        """
+        Updates the policy after the world has been edited, e.g. with 'World.set_wall' or 'World.set_goal_pos',
+        warm-starting from the current policy and value function. States whose action has become infeasible, as well as
+        newly freed cells, start with the greedy action with respect to the previous value function. Since most of the
+        policy typically remains optimal, only a few iterations are needed.
+
+        :param max_iterations: Maximum allowable number of iterations
+        :return: The value function of the policy at the last iteration
+        """
+        if self.policy is None:
+            return self.execute(max_iterations)
+
+        model = self.world.compile()
+        values = model.to_flat(self.__value_fn).astype(np.float64)
+        policy_actions = model.policy_to_indices(self.policy)
+
+        infeasible = ~model.action_mask[np.arange(model.num_states), policy_actions]
+        newly_freed = model.to_flat(self.__solved_model.state_index) == -1
+        repaired = infeasible | newly_freed
+        if repaired.any():
+            q = model.q_values(model.expected_costs(self.transition_costs()), values, self.discount_factor)
+            policy_actions[repaired] = np.argmin(q[repaired], axis=1)
+
+        self.set_policy_actions(policy_actions)
+        self.__values = values
+        return self.__iterate(max_iterations)
+
+    def __iterate(self, max_iterations):
         value_fn = None
 
+        self.iterations = 0
+        self.evaluation_sweeps = 0
+        self.sweeps_per_iteration = list()
+
+        for observer in self.observers:
+            observer.on_start(self)
+
         has_converged = False
         for i in range(max_iterations):
             # policy evaluation
+            self.__transition_time = 0.
+            start_time = time.perf_counter()
             value_fn = self.evaluate()
+            self.__value_fn = value_fn
+            self.__solved_model = self.world.compile()
+            evaluation_time = time.perf_counter() - start_time - self.__transition_time
 
             # policy improvement
-            prev_policy = np.copy(self.policy)
-            self.improve(value_fn)
-
-            # check for convergence
-            if not self.has_policy_changed(prev_policy):
-                print("Policy iteration has converged after %d iterations" % (i + 1))
-                has_converged = True
-                break
+            start_time = time.perf_counter()
+            changed_states = self.improve(value_fn)
+            improvement_time = time.perf_counter() - start_time
+            self.iterations = i + 1
+
+            if self.observers:
+                self.__notify_iteration(i, value_fn, changed_states, (self.__transition_time, evaluation_time,
+                                                                      improvement_time))
+
+            # check for convergence. Modified evaluation only approximates the value of the policy, so the values must
+            # have settled as well.
+            if not changed_states.any():
+                if self.evaluation != 'modified':
+                    print("Policy iteration has converged after %d iterations" % (i + 1))
+                    has_converged = True
+                    break
+                elif self.evaluation_residual <= self.tol:
+                    print("Policy iteration has converged after %d iterations (%d evaluation sweeps)" %
+                          (i + 1, self.evaluation_sweeps))
+                    has_converged = True
+                    break
 
         if not has_converged:
             print("ERROR: Policy iteration did not converge after %d iterations" % max_iterations)
 
+        for observer in self.observers:
+            observer.on_finish(self)
+
         return value_fn
 
+    def __notify_iteration(self, i, value_fn, changed_states, timings):
+        # the residual is the Bellman residual of the evaluated value function under the optimal Bellman operator
+        model = self.world.compile()
+        values = model.to_flat(value_fn).astype(np.float64)
+        q = model.q_values(model.expected_costs(self.transition_costs()), values, self.discount_factor)
+        residuals = np.absolute(q.min(axis=1) - values)
+
+        record = {
+            'iteration': i + 1, 'max_residual': float(residuals.max(initial=0.)),
+            'mean_residual': float(residuals.mean()) if len(residuals) else 0.,
+            'policy_changes': int(np.count_nonzero(changed_states)),
+            'transition_time': timings[0], 'evaluation_time': timings[1], 'improvement_time': timings[2],
+        }
+        for observer in self.observers:
+            observer.on_iteration(self, record)
+
+    # the policy as an array of shape [H, W, 2] holding the displacement of the action of every cell
+    policy            = property(fget=lambda self: self.__get_policy(),
+                                 fset=lambda self, policy: self.__set_policy(policy))
     state_cardinality = property(fget=lambda self: self.world.world_width * self.world.world_height)
@@ -0,0 +1,136 @@
+from cost_functions import transition_costs
+from multiprocessing import shared_memory
+from transition_model import TransitionModel
+from world import World
+
+import numpy as np
+
+
+def attach_shared_array(descriptor):
+    """
+    Attaches to an array in shared memory which was created by another process.
+
+    :param descriptor: Tuple of (shared memory name, shape, dtype string)
+    :return: Tuple of (array, SharedMemory instance). The SharedMemory instance must be kept alive as long as the array
+    is in use.
+    """
+    name, shape, dtype = descriptor
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching always registers the block with the resource tracker. Child processes share the
+        # tracker of their parent, in which the block is already registered, so this is harmless.
+        block = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, np.dtype(dtype), buffer=block.buf), block
+
+
+class SharedArrays(object):
+    def __init__(self):
+        """
+        Ctor for a collection of arrays in shared memory which are owned by the creating process.
+        """
+        self.arrays = dict()
+        self.descriptors = dict()
+        self.__blocks = list()
+
+    def create(self, name, shape, dtype, fill=None):
+        """
+        Allocates a new array in shared memory.
+
+        :param name: Key under which the array is stored in 'arrays' and 'descriptors'
+        :param shape: Shape of the array
+        :param dtype: Data type of the array
+        :param fill: Value to initialize the array with, or None to leave it zeroed
+        :return: The shared array
+        """
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        if fill is not None:
+            array[...] = fill
+
+        self.__blocks.append(block)
+        self.arrays[name] = array
+        self.descriptors[name] = (block.name, tuple(shape), dtype.str)
+        return array
+
+    def share(self, name, array):
+        """
+        Copies an array into shared memory.
+
+        :param name: Key under which the array is stored in 'arrays' and 'descriptors'
+        :param array: Array to copy
+        :return: The shared array
+        """
+        array = np.asarray(array)
+        shared = self.create(name, array.shape, array.dtype)
+        shared[...] = array
+        return shared
+
+    def release(self):
+        """
+        Frees the shared memory. The arrays must not be used by any process afterwards.
+        :return: None
+        """
+        self.arrays = dict()
+        for block in self.__blocks:
+            block.close()
+            block.unlink()
+        self.__blocks = list()
+
+
+class SharedWorld(SharedArrays):
+    def __init__(self, world, one_step_cost_fns=()):
+        """
+        Ctor for a world whose occupancy grid and compiled transition model are placed in shared memory, so that
+        worker processes can use them without parsing, compiling or unpickling the world again.
+
+        :param world: Instance of class 'World'
+        :param one_step_cost_fns: One-step cost functions whose per-transition costs are computed once and shared as
+        well. They must be defined at module level so that they can be passed to other processes.
+        """
+        super(SharedWorld, self).__init__()
+        model = world.compile()
+
+        self.share('map', world.map)
+        for name in TransitionModel.ARRAYS:
+            self.share(name, getattr(model, name))
+
+        self.one_step_cost_fns = list(one_step_cost_fns)
+        for i, one_step_cost_fn in enumerate(self.one_step_cost_fns):
+            self.share('cost_%d' % i, transition_costs(world, one_step_cost_fn))
+
+        self.handle = {
+            'descriptors': self.descriptors,
+            'start_pos': tuple(world.start_pos),
+            'goal_pos': tuple(world.goal_pos),
+            'trap_pos': tuple(world.trap_pos),
+            'action_stochasticity': world.action_stochasticity,
+            'one_step_cost_fns': self.one_step_cost_fns,
+        }
+
+    @staticmethod
+    def attach(handle):
+        """
+        Recreates the shared world in another process.
+
+        :param handle: The 'handle' attribute of the SharedWorld in the creating process
+        :return: Tuple of (World instance, list of SharedMemory instances which must be kept alive while the world is
+        in use)
+        """
+        arrays = dict()
+        blocks = list()
+        for name, descriptor in handle['descriptors'].items():
+            arrays[name], block = attach_shared_array(descriptor)
+            blocks.append(block)
+
+        world = World()
+        world.set_grid(arrays['map'], handle['start_pos'], handle['goal_pos'], handle['trap_pos'])
+        model = TransitionModel.from_arrays(arrays, handle['action_stochasticity'])
+        world.attach_model(model)
+
+        for i, one_step_cost_fn in enumerate(handle['one_step_cost_fns']):
+            model.cost_cache[one_step_cost_fn] = arrays['cost_%d' % i]
+
+        return world, blocks
+
@@ -0,0 +1,145 @@
+from cost_functions import transition_costs
+
+import numpy as np
+import scipy.stats
+
+
+class RolloutSimulator(object):
+    def __init__(self, world, one_step_cost_fn, discount_factor=0.9, seed=None):
+        """
+        Ctor for a Monte Carlo simulator which validates a policy by executing it with many agents at once. All agents
+        advance in lockstep: every step samples the successors of all agents from the compiled transition model with a
+        single vectorized draw.
+
+        :param world: Instance of class 'World'
+        :param one_step_cost_fn: Method that returns the one step cost given an instance of World, the current position
+        and the next position. May also be a batched cost function, see 'cost_functions'.
+        :param discount_factor: In range [0, 1)
+        :param seed: Seed of the random number generator. Simulators with the same seed produce the same rollouts.
+        """
+        self.world = world
+        self.one_step_cost_fn = one_step_cost_fn
+        self.discount_factor = discount_factor
+        self.rng = np.random.default_rng(seed)
+
+    def simulate(self, policy, num_agents=1000, horizon=None, start_pos=None, confidence=0.95, value_fn=None):
+        """
+        Executes a policy with 'num_agents' agents from the same start position and reports the statistics of their
+        discounted costs.
+
+        :param policy: Policy as an array of shape [H, W, 2], or as per-state action indices of shape [num_states] like
+        'PolicyIteration.policy_actions'
+        :param num_agents: Number of simulated agents
+        :param horizon: Number of steps per agent. Since the rollouts are truncated after this many steps, the
+        discounted cost is only accurate up to 'truncation_error'. Defaults to the number of steps after which the
+        discount has dropped below 10e-4.
+        :param start_pos: Start position of all agents. Defaults to 'world.start_pos'.
+        :param confidence: Confidence level of the reported intervals
+        :param value_fn: Optional value function to compare with, e.g. that of a solver
+        :return: Dict with the mean, standard deviation and confidence interval of the discounted cost ('mean_cost',
+        'std_cost', 'cost_interval'), the fraction of agents which have reached the goal and the trap at least once
+        with their confidence intervals ('goal_rate', 'goal_interval', 'trap_rate', 'trap_interval'), the mean number of
+        steps until the goal was first reached by those agents ('mean_steps_to_goal'), 'truncation_error' and, if
+        'value_fn' is given, its value at the start position ('expected_cost') and whether it lies within the cost
+        interval widened by the truncation error ('consistent').
+        """
+        if not 0. <= self.discount_factor < 1.:
+            raise ValueError("The discount factor must be in range [0, 1)")
+        if num_agents < 2:
+            raise ValueError("At least two agents are needed to estimate confidence intervals")
+
+        model = self.world.compile()
+        start_pos = self.world.start_pos if start_pos is None else np.asarray(start_pos, np.int32)
+        if not self.world.is_within_bounds(start_pos) or model.state_index[start_pos[1], start_pos[0]] == -1:
+            raise ValueError("The start position (%d, %d) is not a free cell" % (start_pos[0], start_pos[1]))
+
+        if horizon is None:
+            horizon = int(np.ceil(np.log(10e-4) / np.log(self.discount_factor))) if self.discount_factor > 0. else 1
+
+        next_states, cumulative_probs, costs = self.__policy_tables(model, policy)
+        goal_idx = self.__state_idx(model, self.world.goal_pos)
+        trap_idx = self.__state_idx(model, self.world.trap_pos)
+
+        states = np.full(num_agents, model.state_index[start_pos[1], start_pos[0]], np.int64)
+        total_costs = np.zeros(num_agents, np.float64)
+        steps_to_goal = np.full(num_agents, -1, np.int64)
+        reached_trap = np.zeros(num_agents, bool)
+        discount = 1.
+
+        for step in range(horizon):
+            # index of the sampled successor slot: the number of cumulative probabilities not exceeding the draw
+            samples = self.rng.random(num_agents)
+            slots = np.sum(samples[:, None] >= cumulative_probs[states], axis=1)
+
+            total_costs += discount * costs[states, slots]
+            states = next_states[states, slots]
+            discount *= self.discount_factor
+
+            steps_to_goal[(states == goal_idx) & (steps_to_goal == -1)] = step + 1
+            reached_trap |= states == trap_idx
+
+        z = scipy.stats.norm.ppf(0.5 + 0.5 * confidence)
+        mean_cost = float(total_costs.mean())
+        std_cost = float(total_costs.std(ddof=1))
+        half_width = float(z * std_cost / np.sqrt(num_agents))
+        reached_goal = steps_to_goal != -1
+
+        # the truncated tail of the discounted cost is bounded by the largest one-step cost of the policy
+        truncation_error = discount * float(np.max(np.absolute(costs), initial=0.)) / (1. - self.discount_factor)
+
+        report = {
+            'num_agents': num_agents, 'horizon': horizon,
+            'mean_cost': mean_cost, 'std_cost': std_cost, 'cost_interval': (mean_cost - half_width,
+                                                                              mean_cost + half_width),
+            'goal_rate': float(reached_goal.mean()), 'goal_interval': self.__wilson_interval(reached_goal, z),
+            'trap_rate': float(reached_trap.mean()), 'trap_interval': self.__wilson_interval(reached_trap, z),
+            'mean_steps_to_goal': float(steps_to_goal[reached_goal].mean()) if reached_goal.any() else None,
+            'truncation_error': truncation_error,
+        }
+
+        if value_fn is not None:
+            expected_cost = float(value_fn[start_pos[1], start_pos[0]])
+            report['expected_cost'] = expected_cost
+            report['consistent'] = bool(mean_cost - half_width - truncation_error <= expected_cost <=
+                                        mean_cost + half_width + truncation_error)
+
+        return report
+
+    def __policy_tables(self, model, policy):
+        # Gathers the successors of the action of every state into tables of shape [num_states, 3], which hold the
+        # successor, the cumulative probability and the one-step cost of every slot. The cumulative probability of the
+        # last valid slot and of unused slots is infinite, so that every draw in [0, 1) selects a valid slot.
+        policy = np.asarray(policy)
+        policy_actions = policy if policy.ndim == 1 else model.policy_to_indices(policy)
+        if policy_actions.shape != (model.num_states,):
+            raise ValueError("The policy must have one action per free state of the world")
+        if not model.action_mask[np.arange(model.num_states), policy_actions].all():
+            raise ValueError("The policy contains actions which are not allowed")
+
+        rows = np.arange(model.num_states) * model.num_actions + policy_actions.astype(np.int64)
+        starts, counts = model.indptr[rows], model.indptr[rows + 1] - model.indptr[rows]
+        num_slots = int(counts.max(initial=1))
+
+        slots = np.arange(num_slots)
+        valid = slots[None, :] < counts[:, None]
+        transitions = np.where(valid, starts[:, None] + slots[None, :], 0)
+
+        next_states = np.where(valid, model.next_states[transitions], 0)
+        costs = np.where(valid, transition_costs(self.world, self.one_step_cost_fn)[transitions], 0.)
+        cumulative_probs = np.cumsum(np.where(valid, model.probs[transitions], 0.), axis=1)
+        cumulative_probs[slots[None, :] >= counts[:, None] - 1] = np.inf
+        return next_states, cumulative_probs, costs
+
+    def __state_idx(self, model, pos):
+        if not self.world.is_within_bounds(pos):
+            return -1
+        return model.state_index[pos[1], pos[0]]
+
+    def __wilson_interval(self, hits, z):
+        # Wilson score interval of a binomial proportion, which unlike the normal approximation stays within [0, 1] and
+        # is informative for rates close to 0 or 1
+        n = float(len(hits))
+        rate = hits.mean()
+        center = (rate + z ** 2 / (2. * n)) / (1. + z ** 2 / n)
+        half_width = z / (1. + z ** 2 / n) * np.sqrt(rate * (1. - rate) / n + z ** 2 / (4. * n ** 2))
+        return max(0., float(center - half_width)), min(1., float(center + half_width))
@@ -0,0 +1,160 @@
+from cost_functions import cost_fn_identity
+
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+
+
+class SolutionCache(object):
+    SUFFIX = '.npz'
+
+    def __init__(self, directory, max_entries=128, max_bytes=None, max_gamma_distance=0.1):
+        """
+        Ctor for an on-disk cache of solved worlds. Every entry holds the value function and policy of one solver run
+        and is stored as a .npz file whose name is derived from the content of the world, the one-step cost function
+        and the solver parameters, so that entries stay valid across runs and processes. The least recently used entries
+        are evicted once the cache exceeds 'max_entries' or 'max_bytes'.
+
+        :param directory: Directory in which the entries are stored. It is created if it does not exist.
+        :param max_entries: Maximum number of entries
+        :param max_bytes: Maximum total size of the entries in bytes, or None for no limit
+        :param max_gamma_distance: Entries for the same world and cost function whose discount factor differs by at
+        most this much are used as warm starts, see 'nearest'
+        """
+        if max_entries < 1:
+            raise ValueError("The cache must be able to hold at least one entry")
+
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_gamma_distance = max_gamma_distance
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, world, one_step_cost_fn, parameters):
+        """
+        Computes the key of a solution.
+
+        :param world: Instance of class 'World'
+        :param one_step_cost_fn: Scalar or batched one-step cost function
+        :param parameters: Dict of the solver parameters which determine the solution, including 'discount_factor'.
+        Values must be serializable to JSON.
+        :return: Tuple of (family, key). The family only covers the world and the cost function, so that it is shared
+        by the solutions for all parameters.
+        """
+        family = hashlib.sha256((world.fingerprint() + cost_fn_identity(one_step_cost_fn)).encode()).hexdigest()[:32]
+        params = json.dumps(parameters, sort_keys=True)
+        return family, hashlib.sha256((family + params).encode()).hexdigest()[:32]
+
+    def get(self, key):
+        """
+        Loads the entry with the given key and marks it as recently used.
+
+        :param key: Key as returned by 'key'
+        :return: Dict with the arrays of the entry, or None if there is no such entry
+        """
+        return self.__load(self.__path(key))
+
+    def nearest(self, key, discount_factor):
+        """
+        Loads the entry of the same family as 'key' whose discount factor is closest to 'discount_factor', e.g. to
+        warm-start a solver. Entries with the exact key are not considered.
+
+        :param key: Key as returned by 'key'
+        :param discount_factor: Discount factor of the solution which is to be computed
+        :return: Dict with the arrays of the entry, or None if no entry is within 'max_gamma_distance'
+        """
+        best_path, best_distance = None, np.inf
+        for filename in os.listdir(self.directory):
+            if not filename.startswith(key[0] + '-') or filename == os.path.basename(self.__path(key)):
+                continue
+            try:
+                with np.load(os.path.join(self.directory, filename)) as entry:
+                    distance = abs(float(entry['discount_factor']) - discount_factor)
+            except (IOError, OSError, KeyError, ValueError):
+                continue  # evicted or incomplete in the meantime
+            if distance <= self.max_gamma_distance and distance < best_distance:
+                best_path, best_distance = os.path.join(self.directory, filename), distance
+
+        return self.__load(best_path) if best_path else None
+
+    def put(self, key, value_fn, policy, discount_factor, **arrays):
+        """
+        Stores a solution and evicts the least recently used entries if the cache has become too large.
+
+        :param key: Key as returned by 'key'
+        :param value_fn: Value function as a 2D array
+        :param policy: Policy as an array of shape [H, W, 2]
+        :param discount_factor: Discount factor of the solution
+        :param arrays: Further arrays or scalars to store with the entry
+        :return: None
+        """
+        # write to a temporary file first, so that concurrent readers never see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as writefile:
+                np.savez(writefile, value_fn=value_fn, policy=np.asarray(policy, np.int8),
+                         discount_factor=discount_factor, **arrays)
+            os.replace(tmp_path, self.__path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within 'max_entries' and 'max_bytes'.
+        :return: None
+        """
+        entries = list()
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.directory, filename))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or
+                           (self.max_bytes is not None and total_bytes > self.max_bytes)):
+            _, size, filename = entries.pop(0)
+            total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Removes all entries.
+        :return: None
+        """
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.SUFFIX):
+                os.remove(os.path.join(self.directory, filename))
+
+    def __len__(self):
+        return sum(1 for filename in os.listdir(self.directory) if filename.endswith(self.SUFFIX))
+
+    def __path(self, key):
+        return os.path.join(self.directory, '%s-%s%s' % (key[0], key[1], self.SUFFIX))
+
+    def __load(self, path):
+        try:
+            with np.load(path) as entry:
+                arrays = dict((name, entry[name]) for name in entry.files)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # the modification time of an entry is its last use
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return arrays
@@ -0,0 +1,137 @@
+from benchmark import COST_FNS, SOLVERS
+from contextlib import redirect_stdout
+from shared_world import SharedArrays, SharedWorld, attach_shared_array
+from world import World
+
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import time
+
+# state of a worker process, set up once by 'init_worker'
+worker_state = dict()
+
+
+def init_worker(world_handle, output_descriptors):
+    world, blocks = SharedWorld.attach(world_handle)
+    outputs = dict()
+    for name, descriptor in output_descriptors.items():
+        outputs[name], block = attach_shared_array(descriptor)
+        blocks.append(block)
+
+    worker_state['world'] = world
+    worker_state['outputs'] = outputs
+    worker_state['blocks'] = blocks
+
+
+def run_job(job):
+    job_idx, gamma, cost_name, solver_name, eps = job
+    world = worker_state['world']
+    model = world.compile()
+
+    start_time = time.perf_counter()
+    solver = SOLVERS[solver_name](world, COST_FNS[cost_name], gamma, eps)
+    with redirect_stdout(io.StringIO()):
+        value_fn = solver.execute()
+    value_fn = solver.value_fn if value_fn is None else value_fn
+    policy_actions = solver.policy_actions if hasattr(solver, 'policy_actions') else solver.extract_policy_actions()
+    wall_time = time.perf_counter() - start_time
+
+    # the results are written to shared memory, so that only the metrics need to be sent back
+    worker_state['outputs']['values'][job_idx] = model.to_flat(value_fn)
+    worker_state['outputs']['policies'][job_idx] = policy_actions
+
+    return {
+        'job': job_idx, 'gamma': gamma, 'cost_fn': cost_name, 'solver': solver_name, 'iterations': solver.iterations,
+        'wall_time': wall_time, 'pid': os.getpid(),
+    }
+
+
+class ParameterSweep(object):
+    def __init__(self, world, processes=None, eps=10e-7):
+        """
+        Ctor for a runner which solves the same world for many combinations of discount factor, cost function and
+        solver in parallel. The compiled world is placed in shared memory once and used by all worker processes.
+
+        :param world: Instance of class 'World'
+        :param processes: Number of worker processes. Defaults to the number of cores.
+        :param eps: Convergence threshold passed to the solvers
+        """
+        self.world = world
+        self.processes = processes if processes else os.cpu_count()
+        self.eps = eps
+
+    def run(self, gammas, cost_names, solver_names):
+        """
+        Solves all combinations of the given parameters. Results are yielded in the order in which the jobs complete.
+
+        :param gammas: List of discount factors
+        :param cost_names: List of keys of 'benchmark.COST_FNS'
+        :param solver_names: List of keys of 'benchmark.SOLVERS'
+        :return: Generator of dicts holding the parameters and metrics of a job, together with its value function
+        ('value_fn') and policy ('policy')
+        """
+        for solver_name in solver_names:
+            if solver_name not in SOLVERS:
+                raise ValueError("Unknown solver '%s'. Must be one of %s" % (solver_name, ', '.join(sorted(SOLVERS))))
+
+        jobs = [(job_idx, gamma, cost_name, solver_name, self.eps) for job_idx, (gamma, cost_name, solver_name) in
+                enumerate(itertools.product(gammas, cost_names, solver_names))]
+
+        model = self.world.compile()
+        shared_world = SharedWorld(self.world, [COST_FNS[cost_name] for cost_name in sorted(set(cost_names))])
+        outputs = SharedArrays()
+        values = outputs.create('values', (len(jobs), model.num_states), np.float64)
+        policies = outputs.create('policies', (len(jobs), model.num_states), np.uint8)
+
+        try:
+            with multiprocessing.Pool(self.processes, initializer=init_worker,
+                                      initargs=(shared_world.handle, outputs.descriptors)) as pool:
+                for result in pool.imap_unordered(run_job, jobs):
+                    result['value_fn'] = model.to_grid(values[result['job']], np.float32)
+                    result['policy'] = model.indices_to_policy(policies[result['job']], np.int32)
+                    yield result
+        finally:
+            outputs.release()
+            shared_world.release()
+
+
+def main(args):
+    print("Reading world from %s" % args.world)
+    world = World(args.world)
+    sweep = ParameterSweep(world, args.processes, args.eps)
+
+    start_time = time.perf_counter()
+    value_fns = dict()
+    policies = dict()
+
+    for result in sweep.run(args.gammas, args.cost_fns, args.solvers):
+        key = '%s_%s_%g' % (result['solver'], result['cost_fn'], result['gamma'])
+        value_fns[key] = result.pop('value_fn')
+        policies[key] = result.pop('policy')
+        print(json.dumps(result))
+
+    print("Solved %d jobs in %.2f s using %d processes" % (len(value_fns), time.perf_counter() - start_time,
+                                                           sweep.processes))
+
+    if args.output:
+        np.savez(args.output, **dict([('value_fn_' + key, value_fn) for key, value_fn in value_fns.items()] +
+                                     [('policy_' + key, policy) for key, policy in policies.items()]))
+        print("Value functions and policies written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Solves a world for many discount factors, cost functions and "
+                                                 "solvers in parallel.")
+    parser.add_argument('--world', '-w', required=True)
+    parser.add_argument('--gammas', type=float, nargs='+', default=[0.5, 0.9, 0.99])
+    parser.add_argument('--cost-fns', nargs='+', default=sorted(COST_FNS.keys()), choices=sorted(COST_FNS.keys()))
+    parser.add_argument('--solvers', nargs='+', default=['vi_vectorized', 'pi_sparse'])
+    parser.add_argument('--processes', '-p', type=int, required=False)
+    parser.add_argument('--eps', type=float, default=10e-7)
+    parser.add_argument('--output', '-o', required=False, help="Path of an .npz file for the results")
+    main(parser.parse_args())
@@ -0,0 +1,163 @@
+from shared_world import SharedArrays, SharedWorld, attach_shared_array
+
+import multiprocessing
+import numpy as np
+
+
+def tile_partition(model, tiles):
+    """
+    Assigns every state to a rectangular tile of the world.
+
+    :param model: Instance of class 'TransitionModel'
+    :param tiles: Tuple of (number of tile rows, number of tile columns)
+    :return: Integer array of shape [num_states] holding the tile index of every state
+    """
+    height, width = model.world_shape
+    tile_ys = model.states[:, 1].astype(np.int64) * tiles[0] // height
+    tile_xs = model.states[:, 0].astype(np.int64) * tiles[1] // width
+    return tile_ys * tiles[1] + tile_xs
+
+
+class Tile(object):
+    def __init__(self, model, tile_of_state, tile_idx, expected_costs):
+        """
+        Ctor for the part of the transition model which a single worker sweeps over. The local value array holds the
+        states of the tile, followed by its halo, i.e. the states of other tiles which the tile can transition to.
+
+        :param model: Instance of class 'TransitionModel'
+        :param tile_of_state: Tile index of every state as returned by 'tile_partition'
+        :param tile_idx: Index of this tile
+        :param expected_costs: Expected one-step cost of every (state, action) pair of the model
+        """
+        num_actions = model.num_actions
+        self.states = np.flatnonzero(tile_of_state == tile_idx)
+
+        transitions = np.flatnonzero(tile_of_state[model.rows // num_actions] == tile_idx)
+        next_states = model.next_states[transitions]
+        self.halo = np.setdiff1d(np.unique(next_states), self.states)
+
+        local_index = np.full(model.num_states, -1, np.int64)
+        local_index[self.states] = np.arange(len(self.states))
+        local_index[self.halo] = len(self.states) + np.arange(len(self.halo))
+
+        self.rows = local_index[model.rows[transitions] // num_actions] * num_actions + \
+            model.rows[transitions] % num_actions
+        self.next_states = local_index[next_states]
+        self.probs = model.probs[transitions]
+        self.expected_costs = expected_costs[self.states]
+        self.action_mask = model.action_mask[self.states]
+
+        # states of this tile which are in the halo of some other tile, i.e. the only ones that other tiles read
+        is_boundary = np.zeros(model.num_states, bool)
+        other_rows = tile_of_state[model.rows // num_actions] != tile_idx
+        is_boundary[model.next_states[other_rows]] = True
+        self.boundary = np.flatnonzero(is_boundary[self.states])
+
+    def sweep(self, values, discount_factor):
+        """
+        Applies the optimal Bellman operator to the states of the tile.
+
+        :param values: Local value array of the tile, i.e. values of the tile states followed by those of the halo
+        :param discount_factor: In range [0, 1)
+        :return: New values of the tile states
+        """
+        num_states, num_actions = self.action_mask.shape
+        expected_values = np.bincount(self.rows, self.probs * values[self.next_states],
+                                      minlength=num_states * num_actions).reshape(num_states, num_actions)
+        q = self.expected_costs + discount_factor * expected_values
+        q[~self.action_mask] = np.inf
+        return q.min(axis=1)
+
+
+def tile_worker(world_handle, output_descriptors, tiles, tile_idx, discount_factor, eps, max_iterations, barrier):
+    world, blocks = SharedWorld.attach(world_handle)
+    outputs = dict()
+    for name, descriptor in output_descriptors.items():
+        outputs[name], block = attach_shared_array(descriptor)
+        blocks.append(block)
+
+    model = world.compile()
+    costs = model.cost_cache[world_handle['one_step_cost_fns'][0]]
+    tile = Tile(model, tile_partition(model, tiles), tile_idx, model.expected_costs(costs))
+
+    shared_values, residuals = outputs['values'], outputs['residuals']
+    values = np.concatenate([shared_values[tile.states], shared_values[tile.halo]])
+    num_tile_states = len(tile.states)
+
+    for k in range(max_iterations):
+        new_values = tile.sweep(values, discount_factor)
+        residuals[tile_idx] = np.max(np.absolute(new_values - values[:num_tile_states]), initial=0.)
+        values[:num_tile_states] = new_values
+
+        # halo exchange: publish the boundary of this tile, then read the halo once all tiles have done so
+        shared_values[tile.states[tile.boundary]] = new_values[tile.boundary]
+        barrier.wait()
+        values[num_tile_states:] = shared_values[tile.halo]
+        has_converged = residuals.max() <= eps
+        barrier.wait()  # nobody may overwrite the residuals before all tiles have checked them
+
+        if has_converged:
+            break
+
+    shared_values[tile.states] = values[:num_tile_states]
+    if tile_idx == 0:
+        outputs['iterations'][0] = k + 1
+
+
+def solve_tiled(world, one_step_cost_fn, discount_factor, eps, initial_values, max_iterations, processes, tiles=None):
+    """
+    Runs synchronous value iteration with the world split into tiles which are swept by separate worker processes. The
+    workers share the compiled world and a value array through shared memory, and only exchange the values at the tile
+    boundaries after every sweep.
+
+    :param world: Instance of class 'World'
+    :param one_step_cost_fn: Scalar or batched one-step cost function defined at module level
+    :param discount_factor: In range [0, 1)
+    :param eps: Threshold for value function convergence
+    :param initial_values: Initial value of every state, array of shape [num_states]
+    :param max_iterations: Maximum allowable number of iterations
+    :param processes: Number of worker processes
+    :param tiles: Tuple of (number of tile rows, number of tile columns) whose product equals 'processes'. Defaults to
+    horizontal bands.
+    :return: Tuple of (values of shape [num_states], number of iterations)
+    """
+    tiles = tiles if tiles is not None else (processes, 1)
+    if tiles[0] * tiles[1] != processes:
+        raise ValueError("The number of tiles (%d x %d) must equal the number of processes (%d)" %
+                         (tiles[0], tiles[1], processes))
+
+    shared_world = SharedWorld(world, [one_step_cost_fn])
+    outputs = SharedArrays()
+    outputs.share('values', np.asarray(initial_values, np.float64))
+    outputs.create('residuals', (processes,), np.float64)
+    outputs.create('iterations', (1,), np.int64)
+
+    context = multiprocessing.get_context()
+    barrier = context.Barrier(processes)
+    workers = [context.Process(target=tile_worker, args=(shared_world.handle, outputs.descriptors, tiles, tile_idx,
+                                                         discount_factor, eps, max_iterations, barrier))
+               for tile_idx in range(processes)]
+
+    try:
+        for worker in workers:
+            worker.start()
+
+        # a failing worker would leave the others waiting at the barrier forever
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=0.1)
+                if worker.exitcode not in (None, 0):
+                    barrier.abort()
+                    for other_worker in workers:
+                        other_worker.join()
+                    raise RuntimeError("Tile worker %d failed with exit code %d" %
+                                       (workers.index(worker), worker.exitcode))
+
+        if any(worker.exitcode != 0 for worker in workers):
+            raise RuntimeError("A tile worker failed")
+
+        return np.copy(outputs.arrays['values']), int(outputs.arrays['iterations'][0])
+    finally:
+        outputs.release()
+        shared_world.release()
+
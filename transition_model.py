@@ -0,0 +1,265 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+
+class TransitionModel(object):
+    # arrays which fully describe a compiled model, see 'from_arrays'
+    ARRAYS = ('states', 'state_index', 'actions', 'action_mask', 'indptr', 'next_states', 'probs', 'rows')
+
+    def __init__(self, world):
+        """
+        Compiles the transition dynamics of a world into flat arrays. Free cells are enumerated in row-major order and
+        the successors of every (state, action) pair are stored in CSR layout: the transitions of the pair (s, a) occupy
+        the range [indptr[r], indptr[r + 1]) of 'next_states' and 'probs', where r = s * num_actions + a.
+
+        :param world: Instance of class 'World'
+        """
+        height, width = world.map.shape
+        walls = world.wall_mask
+
+        self.world_shape = (height, width)
+        self.action_stochasticity = world.action_stochasticity
+        self.actions = np.array(world.actions, np.int32)
+
+        ys, xs = np.nonzero(~walls)
+        self.states = np.stack([xs, ys], axis=1).astype(np.int32)
+        self.state_index = np.full((height, width), -1, np.int32)
+        self.state_index[ys, xs] = np.arange(len(xs), dtype=np.int32)
+
+        # pad the grid with a border of walls so that out-of-bounds positions read as blocked
+        padded_index = np.full((height + 2, width + 2), -1, np.int32)
+        padded_index[1:-1, 1:-1] = self.state_index
+
+        num_states = len(xs)
+        num_actions = len(self.actions)
+
+        # every (state, action) pair has up to three successor slots: the two residual transitions followed by the
+        # nominal one, in the same order in which 'World.get_transitions' lists them
+        slot_next = np.zeros((num_states, num_actions, 3), np.int32)
+        slot_probs = np.zeros((num_states, num_actions, 3), np.float64)
+        slot_valid = np.zeros((num_states, num_actions, 3), bool)
+
+        def lookup(offset):
+            return padded_index[ys + 1 + offset[1], xs + 1 + offset[0]]
+
+        for a, action in enumerate(self.actions):
+            nominal = lookup(action)
+            allowed = nominal != -1
+            nominal_prob = allowed.astype(np.float64)
+
+            if (action != world.ACTION_IDLE).all():
+                for k, residual_action in enumerate(world.get_residual_transitions(action)):
+                    residual = lookup(residual_action)
+                    residual_valid = allowed & (residual != -1)
+                    slot_next[:, a, k] = residual
+                    slot_valid[:, a, k] = residual_valid
+                    slot_probs[:, a, k] = np.where(residual_valid, self.action_stochasticity, 0.)
+                    nominal_prob -= slot_probs[:, a, k]
+
+            slot_next[:, a, 2] = nominal
+            slot_valid[:, a, 2] = allowed
+            slot_probs[:, a, 2] = nominal_prob
+
+        self.action_mask = slot_valid[:, :, 2].copy()
+
+        counts = slot_valid.sum(axis=2).reshape(-1)
+        self.indptr = np.zeros(num_states * num_actions + 1, np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+        slot_valid = slot_valid.reshape(-1)
+        self.next_states = slot_next.reshape(-1)[slot_valid]
+        self.probs = slot_probs.reshape(-1)[slot_valid]
+        self.rows = np.repeat(np.arange(num_states * num_actions, dtype=np.int32), counts)
+
+        # per-transition costs keyed by one-step cost function, see 'cost_functions.transition_costs'
+        self.cost_cache = dict()
+        self.__successor_graph = None
+        self.__transition_matrix = None
+
+    @staticmethod
+    def from_arrays(arrays, action_stochasticity):
+        """
+        Recreates a compiled model from its arrays without copying them, e.g. from arrays in shared memory.
+
+        :param arrays: Dict which maps every name in 'ARRAYS' to the corresponding array
+        :param action_stochasticity: Action stochasticity of the world that the arrays were compiled from
+        :return: Instance of class 'TransitionModel'
+        """
+        model = TransitionModel.__new__(TransitionModel)
+        for name in TransitionModel.ARRAYS:
+            setattr(model, name, arrays[name])
+
+        model.world_shape = tuple(model.state_index.shape)
+        model.action_stochasticity = action_stochasticity
+        model.cost_cache = dict()
+        model.__successor_graph = None
+        model.__transition_matrix = None
+        return model
+
+    def transition_slice(self, state_idx, action_idx):
+        """
+        Returns the range of transitions belonging to a single (state, action) pair.
+
+        :param state_idx: Flat index of the current state
+        :param action_idx: Index into 'actions'
+        :return: Slice into 'next_states', 'probs' and per-transition arrays of the same layout
+        """
+        # compact policies store the action indices as uint8, which must not overflow here
+        row = int(state_idx) * self.num_actions + int(action_idx)
+        return slice(self.indptr[row], self.indptr[row + 1])
+
+    def transitions(self, state_idx, action_idx):
+        """
+        Returns the successors of a single (state, action) pair.
+
+        :param state_idx: Flat index of the current state
+        :param action_idx: Index into 'actions'
+        :return: Tuple of (next state indices, transition probabilities)
+        """
+        transition_range = self.transition_slice(state_idx, action_idx)
+        return self.next_states[transition_range], self.probs[transition_range]
+
+    def expectation(self, values):
+        """
+        Computes the expected value of 'values' at the next state for every (state, action) pair.
+
+        :param values: Array of shape [num_states]
+        :return: Array of shape [num_states, num_actions]. Entries for actions which are not allowed are zero.
+        """
+        expected = np.bincount(self.rows, self.probs * values[self.next_states], minlength=self.num_pairs)
+        return expected.reshape(self.num_states, self.num_actions)
+
+    def policy_transitions(self, action_indices):
+        """
+        Selects the transitions which follow from executing a fixed action in every state.
+
+        :param action_indices: Integer array of shape [num_states] holding the action index for every state
+        :return: Tuple of (state indices, next state indices, transition probabilities, transition indices), each of
+        shape [num_selected]. The transition indices point into 'next_states' and 'probs'.
+        """
+        selected_rows = np.arange(self.num_states) * self.num_actions + action_indices
+        selected = np.flatnonzero(self.rows == selected_rows[self.rows // self.num_actions])
+        return self.rows[selected] // self.num_actions, self.next_states[selected], self.probs[selected], selected
+
+    def expected_costs(self, transition_costs):
+        """
+        Computes the expected one-step cost of every (state, action) pair.
+
+        :param transition_costs: Array of shape [num_transitions] holding the one-step cost of every transition
+        :return: Array of shape [num_states, num_actions]
+        """
+        expected = np.bincount(self.rows, self.probs * transition_costs, minlength=self.num_pairs)
+        return expected.reshape(self.num_states, self.num_actions)
+
+    def q_values(self, expected_costs, values, discount_factor):
+        """
+        Applies the Bellman operator without the minimization to every (state, action) pair at once.
+
+        :param expected_costs: Array of shape [num_states, num_actions] as returned by 'expected_costs'
+        :param values: Value of every state, array of shape [num_states]
+        :param discount_factor: In range [0, 1)
+        :return: Array of shape [num_states, num_actions]. Actions which are not allowed have infinite cost.
+        """
+        q = expected_costs + discount_factor * self.expectation(values)
+        q[~self.action_mask] = np.inf
+        return q
+
+    def transition_matrix(self):
+        """
+        Returns the transition probabilities as a matrix, so that the expected next-state values of all (state, action)
+        pairs, or of a subset of them, can be computed with a sparse matrix product.
+
+        :return: Sparse matrix of shape [num_states * num_actions, num_states] in CSR format, whose row s * num_actions
+        + a holds the successor distribution of the pair (s, a)
+        """
+        if self.__transition_matrix is None:
+            self.__transition_matrix = scipy.sparse.csr_matrix((self.probs, self.next_states, self.indptr),
+                                                               shape=(self.num_pairs, self.num_states))
+        return self.__transition_matrix
+
+    def successor_graph(self):
+        """
+        Returns the directed graph which connects every state to all states that it can transition to under some action.
+
+        :return: Sparse matrix of shape [num_states, num_states] in CSR format
+        """
+        if self.__successor_graph is None:
+            graph = scipy.sparse.csr_matrix((np.ones(self.num_transitions, np.int8),
+                                             (self.rows // self.num_actions, self.next_states)),
+                                            shape=(self.num_states, self.num_states))
+            graph.sum_duplicates()
+            self.__successor_graph = graph
+        return self.__successor_graph
+
+    def predecessor_graph(self):
+        """
+        Returns the transpose of the successor graph, i.e. row s lists all states that can transition to s.
+
+        :return: Sparse matrix of shape [num_states, num_states] in CSR format
+        """
+        return self.successor_graph().transpose().tocsr()
+
+    def reverse_bfs_order(self, state_idx):
+        """
+        Orders the states by their minimum number of steps to reach the given state. States which cannot reach it are
+        appended in row-major order.
+
+        :param state_idx: Flat index of the target state
+        :return: Integer array of shape [num_states]
+        """
+        order = scipy.sparse.csgraph.breadth_first_order(self.predecessor_graph(), state_idx, directed=True,
+                                                         return_predecessors=False)
+        unreached = np.ones(self.num_states, bool)
+        unreached[order] = False
+        return np.concatenate([order, np.flatnonzero(unreached)]).astype(np.int64)
+
+    def to_flat(self, grid):
+        """
+        Gathers the entries of a [H, W, ...] array at the free states.
+
+        :param grid: Array whose leading dimensions match the world map
+        :return: Array of shape [num_states, ...]
+        """
+        return grid[self.states[:, 1], self.states[:, 0]]
+
+    def to_grid(self, values, dtype=np.float32, fill=0):
+        """
+        Scatters per-state values back into an array with the shape of the world map.
+
+        :param values: Array of shape [num_states, ...]
+        :param dtype: Data type of the returned array
+        :param fill: Value assigned to wall cells
+        :return: Array of shape [H, W, ...]
+        """
+        grid = np.full(self.world_shape + values.shape[1:], fill, dtype)
+        grid[self.states[:, 1], self.states[:, 0]] = values
+        return grid
+
+    def policy_to_indices(self, policy):
+        """
+        Converts a policy given as a grid of displacement vectors into per-state action indices.
+
+        :param policy: Array of shape [H, W, 2]
+        :return: Integer array of shape [num_states]
+        """
+        displacements = self.to_flat(policy)
+        matches = (displacements[:, None, :] == self.actions[None, :, :]).all(axis=2)
+        if not matches.any(axis=1).all():
+            raise ValueError("Policy contains a displacement which is not one of the world's actions")
+        return np.argmax(matches, axis=1)
+
+    def indices_to_policy(self, action_indices, dtype=np.int32):
+        """
+        Converts per-state action indices into a grid of displacement vectors.
+
+        :param action_indices: Integer array of shape [num_states]
+        :param dtype: Data type of the returned array
+        :return: Array of shape [H, W, 2]
+        """
+        return self.to_grid(self.actions[action_indices], dtype)
+
+    num_states      = property(fget=lambda self: self.states.shape[0])
+    num_actions     = property(fget=lambda self: self.actions.shape[0])
+    num_pairs       = property(fget=lambda self: self.states.shape[0] * self.actions.shape[0])
+    num_transitions = property(fget=lambda self: self.next_states.shape[0])
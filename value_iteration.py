@@ -1,23 +1,104 @@
+from cost_functions import transition_costs
+from history import ValueFnHistory
+from multigrid import multigrid_warm_start
+from tiled_value_iteration import solve_tiled
+
+import heapq
 import numpy as np
+import os
+import time
 
 
 class ValueIteration(object):
-    def __init__(self, world, one_step_cost_fn, discount_factor=0.9, eps=10e-4):
+    ENGINES   = ('loop', 'vectorized', 'gauss_seidel', 'prioritized', 'tiled')
+    ORDERINGS = ('row_major', 'alternating', 'goal_bfs')
+    STOPPINGS = ('max_change', 'span', 'bounds', 'policy')
+
+    # default convergence threshold for each precision of the value function. Thresholds much below the resolution of
+    # the stored values cannot be met reliably.
+    DEFAULT_EPS = {'float32': 10e-4, 'float64': 10e-8}
+
+    def __init__(self, world, one_step_cost_fn, discount_factor=0.9, eps=None, engine='loop', ordering='row_major',
+                 history=None, processes=None, tiles=None, stopping='max_change', precision='float32', observers=None,
+                 cache=None, multigrid=False):
         """
         Ctor for value iteration algorithm implementation.
 
         :param world: Instance of class 'World'
-        :param one_step_cost_fn: Method that returns the one step cost given an instance of World, the current position.
+        :param one_step_cost_fn: Method that returns the one step cost given an instance of World, the current position
+        and the next position. May also be a batched cost function, see 'cost_functions'.
         :param discount_factor: In range [0, 1)
-        :param eps: Threshold for value function convergence
+        :param eps: Threshold for value function convergence, see 'stopping'. Defaults to 'DEFAULT_EPS[precision]'.
+        :param engine: 'loop' applies the Bellman operator one state and action at a time. 'vectorized' applies it to
+        all states and actions at once using the compiled transition model and one-step costs which are evaluated only
+        once per transition. 'gauss_seidel' updates the values in place, so that every backup already sees the updates
+        made earlier in the same sweep. 'prioritized' repeatedly backs up the state with the largest Bellman error
+        (prioritized sweeping) until no state has a Bellman error above 'eps'. 'tiled' performs the same sweeps as
+        'vectorized', but splits the world into tiles which are swept in parallel by separate processes that exchange
+        the values at the tile boundaries through shared memory. It requires a one-step cost function defined at
+        module level.
+        :param ordering: Order in which 'gauss_seidel' visits the states. 'row_major' sweeps the map row by row,
+        'alternating' cycles through the four diagonal sweep directions, and 'goal_bfs' visits the states in order of
+        increasing distance to the goal.
+        :param history: Instance of class 'ValueFnHistory' which records the value function of every iteration. By
+        default, all iterations are kept in memory.
+        :param processes: Number of worker processes used by 'tiled'. Defaults to the number of cores.
+        :param tiles: Tuple of (number of tile rows, number of tile columns) used by 'tiled'. Its product must equal
+        'processes'. Defaults to one horizontal band per process.
+        :param stopping: Stopping rule of the 'loop' and 'vectorized' engines, based on the change d = TV - V of the
+        value function V in the last sweep. 'max_change' stops once no value changed by more than 'eps'. 'span' stops
+        once the span seminorm max(d) - min(d) is at most 'eps', and 'bounds' once the MacQueen bounds on the optimal
+        value function are at most 2 * 'eps' apart. 'policy' stops as soon as the bounds prove that the greedy policy is
+        optimal, treating actions whose Q-values are within 'eps' of each other as equivalent. All rules except
+        'max_change' finally move the value function to the midpoint of the bounds. The other engines always use
+        'max_change'.
+        :param precision: 'float32' or 'float64', the data type in which the value function is stored
+        :param observers: List of 'instrumentation.SolverObserver' instances which are notified after every iteration.
+        The 'tiled' engine only notifies them at the start and the end.
+        :param cache: Instance of class 'SolutionCache'. If it holds a solution for the same world, cost function,
+        discount factor, 'eps', stopping rule and precision, 'execute' loads it instead of iterating. Otherwise, it
+        warm-starts from the cached value function with the closest discount factor, if any, and stores the result. The
+        engine is not part of the key, since all engines solve to the same tolerance.
+        :param multigrid: If True, 'execute' starts from the value of a policy which is obtained by solving successively
+        finer coarsened versions of the world, see 'multigrid.multigrid_warm_start', instead of from zero. The engine
+        then solves the original world to 'eps' as usual. Ignored if the cache provides a warm start.
         """
+        if engine not in self.ENGINES:
+            raise ValueError("Unknown engine '%s'. Must be one of %s" % (engine, ', '.join(self.ENGINES)))
+        if ordering not in self.ORDERINGS:
+            raise ValueError("Unknown ordering '%s'. Must be one of %s" % (ordering, ', '.join(self.ORDERINGS)))
+        if stopping not in self.STOPPINGS:
+            raise ValueError("Unknown stopping rule '%s'. Must be one of %s" % (stopping, ', '.join(self.STOPPINGS)))
+        if stopping != 'max_change' and engine not in ('loop', 'vectorized'):
+            raise ValueError("Stopping rule '%s' requires engine 'loop' or 'vectorized'" % stopping)
+        if precision not in self.DEFAULT_EPS:
+            raise ValueError("Unknown precision '%s'. Must be one of %s" % (precision, ', '.join(self.DEFAULT_EPS)))
+
         self.world = world
         self.discount_factor = discount_factor
-        self.eps = eps
-        self.one_step_cost_fn = lambda current_pos, next_pos: one_step_cost_fn(self.world, current_pos, next_pos)
+        self.eps = eps if eps is not None else self.DEFAULT_EPS[precision]
+        self.stopping = stopping
+        self.precision = precision
+        self.engine = engine
+        self.ordering = ordering
+        self.one_step_cost_fn = one_step_cost_fn
+        self.processes = processes if processes else (tiles[0] * tiles[1] if tiles else os.cpu_count())
+        self.tiles = tiles
+        self.observers = list(observers) if observers else list()
+        self.cache = cache
+        self.multigrid = multigrid
 
-        self.value_fn = np.zeros(self.world.map.shape, np.float32)
-        self.value_fn_history = list()
+        self.value_fn = np.zeros(self.world.map.shape, precision)
+        self.value_fn_history = history if history is not None else ValueFnHistory()
+
+        self.iterations = 0
+        self.backups = 0
+
+        # guaranteed bounds on the optimal value function and the maximum error of 'value_fn', set by 'execute'
+        self.value_bounds = None
+        self.error_bound = np.inf
+        self.__change_range = (-np.inf, np.inf)
+        self.__greedy_actions = None
 
     def execute(self, max_iterations=int(10e6)):
         """
@@ -25,77 +106,488 @@ class ValueIteration(object):
         :param max_iterations: Maximum allowable number of iterations
         :return: None
         """
+        self.__start_observers()
+
+        cache_key, warm_start = None, None
+        if self.cache is not None:
+            cache_key = self.cache.key(self.world, self.one_step_cost_fn, {
+                'solver': type(self).__name__, 'discount_factor': self.discount_factor, 'eps': self.eps,
+                'stopping': self.stopping, 'precision': self.precision})
+            if self.__load_cached(self.cache.get(cache_key)):
+                print("Loaded the cached solution")
+                print("Maximum error of the value function: %g" % self.error_bound)
+                for observer in self.observers:
+                    observer.on_finish(self)
+                return
+
+            warm_start = self.cache.nearest(cache_key, self.discount_factor)
+            if warm_start is not None and warm_start['value_fn'].shape != self.value_fn.shape:
+                warm_start = None
+            if warm_start is not None:
+                print("Warm-starting from the cached solution for gamma = %g" % warm_start['discount_factor'])
+                self.value_fn = warm_start['value_fn'].astype(self.precision)
+
+        if self.multigrid and warm_start is None:
+            warm_start = multigrid_warm_start(self.world, self.one_step_cost_fn, self.discount_factor, self.eps)
+            if warm_start is not None:
+                print("Warm-starting from the multigrid solution")
+                self.value_fn = warm_start[0].astype(self.precision)
+
+        if self.engine == 'vectorized':
+            self.__execute_vectorized(max_iterations)
+        elif self.engine == 'gauss_seidel':
+            self.__execute_gauss_seidel(max_iterations)
+        elif self.engine == 'prioritized':
+            self.__execute_prioritized(max_iterations)
+        elif self.engine == 'tiled':
+            self.__execute_tiled(max_iterations)
+        else:
+            self.__execute_loop(max_iterations)
+
+        # only solutions which have converged are cached
+        if cache_key is not None and self.iterations < max_iterations:
+            self.cache.put(cache_key, self.value_fn, self.extract_policy(), self.discount_factor,
+                           lower_bound=self.value_bounds[0], upper_bound=self.value_bounds[1],
+                           error_bound=self.error_bound)
+
+        print("Maximum error of the value function: %g" % self.error_bound)
+        for observer in self.observers:
+            observer.on_finish(self)
+
+    def __load_cached(self, entry):
+        if entry is None or entry['value_fn'].shape != self.value_fn.shape:
+            return False
+
+        self.value_fn = entry['value_fn'].astype(self.precision)
+        self.value_bounds = (entry['lower_bound'], entry['upper_bound'])
+        self.error_bound = float(entry['error_bound'])
+        self.iterations = 0
+        self.backups = 0
+        self.value_fn_history.append(self.value_fn)
+        return True
+
+    def __start_observers(self):
+        self.__greedy_actions = None
+        for observer in self.observers:
+            observer.on_start(self)
+
+    def __notify_iteration(self, model, k, prev_values, values, timings, expected_costs, q=None):
+        # Passes the statistics of an iteration from 'prev_values' to 'values' to the observers. The greedy policy is
+        # derived from 'q', the Q-values of 'prev_values', which are computed here if the engine has not done so.
+        if not self.observers:
+            return
+
+        start_time = time.perf_counter()
+        if q is None:
+            q = model.q_values(expected_costs, prev_values, self.discount_factor)
+        greedy_actions = np.argmin(q, axis=1)
+        policy_changes = None
+        if self.__greedy_actions is not None and self.__greedy_actions.shape == greedy_actions.shape:
+            policy_changes = int(np.sum(greedy_actions != self.__greedy_actions))
+        self.__greedy_actions = greedy_actions
+        improvement_time = time.perf_counter() - start_time
+
+        residuals = np.absolute(values.astype(np.float64) - prev_values)
+        record = {
+            'iteration': k + 1, 'max_residual': float(residuals.max(initial=0.)),
+            'mean_residual': float(residuals.mean()) if len(residuals) else 0., 'policy_changes': policy_changes,
+            'transition_time': timings[0], 'evaluation_time': timings[1], 'improvement_time': improvement_time,
+        }
+        for observer in self.observers:
+            observer.on_iteration(self, record)
+
+    def __execute_loop(self, max_iterations):
+        model = self.world.compile()
+        one_step_costs = transition_costs(self.world, self.one_step_cost_fn)
+        expected_costs = self.expected_costs() if self.stopping == 'policy' or self.observers else None
 
         for k in range(max_iterations):
             prev_value_fn = np.copy(self.value_fn)
             self.value_fn_history.append(prev_value_fn)
+            prev_values = model.to_flat(prev_value_fn)
+            start_time = time.perf_counter()
 
-            for y in range(self.world.world_height):
-                for x in range(self.world.world_width):
-                    state = np.array([x, y], np.int32)
-                    if self.world.is_wall(state):
-                        continue
+            for s, state in enumerate(model.states):
+                min_cost = 10e6
 
-                    min_cost = 10e6
+                for a in np.flatnonzero(model.action_mask[s]):
+                    next_states, probs = model.transitions(s, a)
+                    costs = one_step_costs[model.transition_slice(s, a)]
 
-                    for action in self.world.actions:
-                        if not self.world.is_action_allowed(state, action):
-                            continue
+                    cost_fn = sum([transition_prob * (cost + (self.discount_factor * prev_values[next_state]))
+                                   for next_state, transition_prob, cost in zip(next_states, probs, costs)])
 
-                        transitions = self.world.get_transitions(state, action)
+                    min_cost = min(min_cost, cost_fn)
 
-                        cost_fn = sum([transition_prob * (self.one_step_cost_fn(state, next_state) +
-                                                          (self.discount_factor * prev_value_fn[next_state[1], next_state[0]]))
-                                      for next_state, transition_prob in transitions])
+                if min_cost == 10e6:
+                    raise ValueError("No action could be applied on state (%d, %d). This state is probably "
+                                     "surrounded by walls on all sides." % (state[0], state[1]))
 
-                        min_cost = min(min_cost, cost_fn)
+                self.value_fn[state[1], state[0]] = min_cost
 
-                    if min_cost == 10e6:
-                        raise ValueError("No action could be applied on state (%d, %d). This state is probably "
-                                         "surrounded by walls on all sides.")
+            self.iterations = k + 1
+            self.backups += model.num_states
 
-                    self.value_fn[y, x] = min_cost
+            # the transition lookups are interleaved with the backups, so the whole sweep counts as evaluation
+            evaluation_time = time.perf_counter() - start_time
+            q = model.q_values(expected_costs, prev_values, self.discount_factor) if self.stopping == 'policy' else None
+            self.__notify_iteration(model, k, prev_values, model.to_flat(self.value_fn), (None, evaluation_time),
+                                    expected_costs, q)
+            if self.__has_converged(prev_values, model.to_flat(self.value_fn), q):
+                print("Value iteration has converged after %d iterations" % (k + 1))
+                break
+
+        self.__finish_sweeps(model)
+        self.value_fn_history.append(self.value_fn)
+
+    def __execute_vectorized(self, max_iterations):
+        model = self.world.compile()
+        expected_costs = self.expected_costs()
 
-            if np.sum((np.absolute(self.value_fn - prev_value_fn) > self.eps).astype(np.int32)) == 0:
+        for k in range(max_iterations):
+            prev_value_fn = np.copy(self.value_fn)
+            self.value_fn_history.append(prev_value_fn)
+
+            prev_values = model.to_flat(prev_value_fn)
+            start_time = time.perf_counter()
+            expected_values = model.expectation(prev_values)
+            transition_time = time.perf_counter() - start_time
+
+            q = expected_costs + self.discount_factor * expected_values
+            q[~model.action_mask] = np.inf
+            self.value_fn[model.states[:, 1], model.states[:, 0]] = q.min(axis=1)
+            evaluation_time = time.perf_counter() - start_time - transition_time
+
+            self.iterations = k + 1
+            self.backups += model.num_states
+
+            self.__notify_iteration(model, k, prev_values, model.to_flat(self.value_fn),
+                                    (transition_time, evaluation_time), expected_costs, q)
+            if self.__has_converged(prev_values, model.to_flat(self.value_fn), q):
                 print("Value iteration has converged after %d iterations" % (k + 1))
                 break
 
+        self.__finish_sweeps(model)
+        self.value_fn_history.append(self.value_fn)
+
+    def __has_converged(self, prev_values, values, q):
+        # Applies the stopping rule to a synchronous sweep from 'prev_values' to 'values' = T(prev_values), both in the
+        # precision of the value function. By the MacQueen bounds, the optimal value function lies between
+        # values + factor * min(d) and values + factor * max(d), where d is the change in values.
+        changes = values - prev_values
+        self.__change_range = (float(changes.min()), float(changes.max()))
+        low, high = self.__change_range
+        factor = self.discount_factor / (1. - self.discount_factor)
+
+        if self.stopping == 'max_change':
+            return max(abs(low), abs(high)) <= self.eps
+        elif self.stopping == 'span':
+            return high - low <= self.eps
+        elif self.stopping == 'bounds':
+            return factor * (high - low) <= 2. * self.eps
+
+        # The Q-values of the optimal value function lie within factor * (high - low) of those of 'prev_values' (up to a
+        # common offset), so every action is either within 'eps' of the greedy one or provably worse.
+        gaps = q - q.min(axis=1, keepdims=True)
+        return not ((gaps > self.eps) & (gaps < factor * (high - low))).any()
+
+    def __finish_sweeps(self, model):
+        # sets the bounds on the optimal value function from the change in the last sweep
+        if self.iterations == 0:
+            return self.__set_residual_bounds(model)
+
+        # every backup is rounded to the precision of the value function, which widens the bounds accordingly
+        values = model.to_flat(self.value_fn).astype(np.float64)
+        rounding = np.finfo(self.value_fn.dtype).eps * np.max(np.absolute(values), initial=0.)
+        low, high = self.__change_range[0] - rounding, self.__change_range[1] + rounding
+        factor = self.discount_factor / (1. - self.discount_factor)
+        self.value_bounds = (model.to_grid(values + factor * low, np.float64),
+                             model.to_grid(values + factor * high, np.float64))
+
+        if self.stopping == 'max_change':
+            self.error_bound = factor * max(abs(low), abs(high))
+        else:
+            # the midpoint of the bounds is off by at most half their width
+            self.value_fn = model.to_grid(values + factor * 0.5 * (low + high), self.value_fn.dtype)
+            self.error_bound = factor * 0.5 * (high - low)
+
+    def __set_residual_bounds(self, model):
+        # sets the bounds on the optimal value function from the Bellman residual r = TV - V of the current values V:
+        # the optimal value function lies between V + min(r) / (1 - gamma) and V + max(r) / (1 - gamma)
+        values = model.to_flat(self.value_fn).astype(np.float64)
+        residuals = model.q_values(self.expected_costs(), values, self.discount_factor).min(axis=1) - values
+        rounding = np.finfo(np.float64).eps * np.max(np.absolute(values), initial=0.)
+        low, high = float(residuals.min()) - rounding, float(residuals.max()) + rounding
+        self.value_bounds = (model.to_grid(values + low / (1. - self.discount_factor), np.float64),
+                             model.to_grid(values + high / (1. - self.discount_factor), np.float64))
+        self.error_bound = max(abs(low), abs(high)) / (1. - self.discount_factor)
+
+    def __execute_tiled(self, max_iterations):
+        model = self.world.compile()
+        self.value_fn_history.append(np.copy(self.value_fn))
+
+        # the sweeps run in the worker processes, so only the initial and final value functions are recorded
+        values, self.iterations = solve_tiled(self.world, self.one_step_cost_fn, self.discount_factor, self.eps,
+                                              model.to_flat(self.value_fn), max_iterations, self.processes, self.tiles)
+        self.value_fn = model.to_grid(values, self.value_fn.dtype)
+        self.backups += self.iterations * model.num_states
+
+        if self.iterations < max_iterations:
+            print("Value iteration has converged after %d iterations" % self.iterations)
+
+        self.__set_residual_bounds(model)
         self.value_fn_history.append(self.value_fn)
 
+    def __execute_gauss_seidel(self, max_iterations):
+        model = self.world.compile()
+        backup = self.__state_backup_fn(model)
+        values = model.to_flat(self.value_fn).astype(np.float64)
+        orders = self.sweep_orders()
+        expected_costs = self.expected_costs() if self.observers else None
+
+        for k in range(max_iterations):
+            self.value_fn_history.append(np.copy(self.value_fn))
+            prev_values = np.copy(values) if self.observers else None
+            start_time = time.perf_counter()
+
+            max_change = 0.
+            for s in orders[k % len(orders)]:
+                new_value = backup(s, values)
+                max_change = max(max_change, abs(new_value - values[s]))
+                values[s] = new_value
+
+            self.value_fn[model.states[:, 1], model.states[:, 0]] = values
+            self.iterations = k + 1
+            self.backups += model.num_states
+
+            self.__notify_iteration(model, k, prev_values, values, (None, time.perf_counter() - start_time),
+                                    expected_costs)
+
+            if max_change <= self.eps:
+                print("Value iteration has converged after %d iterations" % (k + 1))
+                break
+
+        self.__set_residual_bounds(model)
+        self.value_fn_history.append(self.value_fn)
+
+    def __execute_prioritized(self, max_iterations):
+        model = self.world.compile()
+        backup = self.__state_backup_fn(model)
+        predecessors = model.predecessor_graph()
+        values = model.to_flat(self.value_fn).astype(np.float64)
+
+        # the priority of a state is its Bellman error. Entries in the heap become stale whenever the priority of their
+        # state changes, and are skipped when popped.
+        q = model.q_values(self.expected_costs(), values, self.discount_factor)
+        priorities = np.absolute(q.min(axis=1) - values)
+        heap = [(-priority, s) for s, priority in enumerate(priorities) if priority > self.eps]
+        heapq.heapify(heap)
+
+        # one iteration corresponds to as many backups as there are states, i.e. the work of one sweep
+        max_backups = max_iterations * model.num_states
+        has_converged = False
+        self.value_fn_history.append(np.copy(self.value_fn))
+
+        expected_costs = self.expected_costs() if self.observers else None
+        prev_values = np.copy(values) if self.observers else None
+        start_time = time.perf_counter()
+
+        while self.backups < max_backups:
+            if not heap:
+                has_converged = True
+                break
+
+            neg_priority, s = heapq.heappop(heap)
+            if -neg_priority != priorities[s]:
+                continue
+
+            values[s] = backup(s, values)
+            priorities[s] = 0.
+            self.backups += 1
+
+            for p in predecessors.indices[predecessors.indptr[s]:predecessors.indptr[s + 1]]:
+                priority = abs(backup(p, values) - values[p])
+                if priority != priorities[p]:
+                    priorities[p] = priority
+                    if priority > self.eps:
+                        heapq.heappush(heap, (-priority, p))
+
+            if self.backups % model.num_states == 0:
+                self.value_fn[model.states[:, 1], model.states[:, 0]] = values
+                self.value_fn_history.append(np.copy(self.value_fn))
+
+                self.__notify_iteration(model, self.backups // model.num_states - 1, prev_values, values,
+                                        (None, time.perf_counter() - start_time), expected_costs)
+                prev_values = np.copy(values) if self.observers else None
+                start_time = time.perf_counter()
+
+        self.value_fn[model.states[:, 1], model.states[:, 0]] = values
+        self.iterations = int(np.ceil(self.backups / float(model.num_states)))
+        if self.backups % model.num_states != 0:
+            self.__notify_iteration(model, self.iterations - 1, prev_values, values,
+                                    (None, time.perf_counter() - start_time), expected_costs)
+
+        if has_converged:
+            print("Value iteration has converged after %d backups (%d iterations)" % (self.backups, self.iterations))
+
+        self.__set_residual_bounds(model)
+        self.value_fn_history.append(self.value_fn)
+
+    def __state_backup_fn(self, model):
+        # Returns a method which computes the optimal Bellman backup of a single state from the given values. The
+        # self-transition of every action is solved for in closed form, which has the same fixed point but lets states
+        # such as an idling goal converge in a single backup instead of geometrically.
+        expected_costs = self.expected_costs()
+        state_indptr = model.indptr[::model.num_actions]
+        transition_actions = model.rows % model.num_actions
+        is_self_transition = model.next_states == model.rows // model.num_actions
+        other_probs = np.where(is_self_transition, 0., model.probs)
+        self_probs = np.bincount(model.rows, np.where(is_self_transition, model.probs, 0.), minlength=model.num_pairs)
+        denominators = 1. - self.discount_factor * self_probs.reshape(model.num_states, model.num_actions)
+
+        def backup(s, values):
+            transitions = slice(state_indptr[s], state_indptr[s + 1])
+            expected_values = np.bincount(transition_actions[transitions],
+                                          other_probs[transitions] * values[model.next_states[transitions]],
+                                          minlength=model.num_actions)
+            q = (expected_costs[s] + self.discount_factor * expected_values) / denominators[s]
+            return q[model.action_mask[s]].min()
+
+        return backup
+
+    def sweep_orders(self):
+        """
+        Returns the orders in which 'gauss_seidel' visits the states. Consecutive sweeps cycle through the returned list.
+        :return: List of integer arrays of shape [num_states]
+        """
+        model = self.world.compile()
+        xs, ys = model.states[:, 0], model.states[:, 1]
+
+        if self.ordering == 'alternating':
+            return [np.lexsort((x_dir * xs, y_dir * ys)) for y_dir, x_dir in [(1, 1), (-1, -1), (1, -1), (-1, 1)]]
+
+        goal_idx = model.state_index[self.world.goal_pos[1], self.world.goal_pos[0]] \
+            if self.world.is_within_bounds(self.world.goal_pos) else -1
+        if self.ordering == 'goal_bfs' and goal_idx != -1:
+            return [model.reverse_bfs_order(goal_idx)]
+
+        return [np.arange(model.num_states)]
+
+    def resolve(self, max_iterations=int(10e6)):
+        """
+        Updates the value function after the world has been edited, e.g. with 'World.set_wall' or
+        'World.set_goal_pos', warm-starting from the current value function. The first sweep checks the Bellman error of
+        every state, after which only the states whose value changed by more than 'eps' and their predecessors are
+        backed up again. Small edits therefore only cost work within their region of influence. Cells which were freed
+        by the edit start at zero.
+
+        :param max_iterations: Maximum allowable number of iterations
+        :return: None
+        """
+        self.__start_observers()
+        model = self.world.compile()
+        transition_matrix = model.transition_matrix()
+        predecessors = model.predecessor_graph()
+
+        expected_costs = self.expected_costs()
+        expected_costs[~model.action_mask] = np.inf
+        expected_costs = expected_costs.reshape(-1)
+
+        values = model.to_flat(self.value_fn).astype(np.float64)
+        self.value_fn = model.to_grid(values, self.value_fn.dtype)
+        self.value_fn_history.append(np.copy(self.value_fn))
+        self.iterations = 0
+        self.backups = 0
+
+        active = np.arange(model.num_states)
+        for k in range(max_iterations):
+            prev_values = np.copy(values) if self.observers else None
+            start_time = time.perf_counter()
+            if 2 * len(active) > model.num_states:
+                # gathering the rows of most states is slower than a full sweep
+                active = np.arange(model.num_states)
+                expected_values = transition_matrix @ values
+                transition_time = time.perf_counter() - start_time
+                q = expected_costs + self.discount_factor * expected_values
+            else:
+                pairs = (active[:, None] * model.num_actions + np.arange(model.num_actions)).reshape(-1)
+                expected_values = transition_matrix[pairs] @ values
+                transition_time = time.perf_counter() - start_time
+                q = expected_costs[pairs] + self.discount_factor * expected_values
+            new_values = q.reshape(len(active), model.num_actions).min(axis=1)
+
+            changed = active[np.absolute(new_values - values[active]) > self.eps]
+            values[active] = new_values
+            self.iterations = k + 1
+            self.backups += len(active)
+
+            self.__notify_iteration(model, k, prev_values, values,
+                                    (transition_time, time.perf_counter() - start_time - transition_time),
+                                    expected_costs.reshape(model.num_states, model.num_actions))
+
+            if len(changed) == 0:
+                print("Value iteration has converged after %d iterations (%d backups)" % (k + 1, self.backups))
+                break
+
+            # the Bellman error can only have changed for states with a successor whose value changed
+            active = np.unique(np.concatenate([changed, predecessors[changed].indices]))
+
+        self.value_fn = model.to_grid(values, self.value_fn.dtype)
+        self.__set_residual_bounds(model)
+        self.value_fn_history.append(self.value_fn)
+
+        for observer in self.observers:
+            observer.on_finish(self)
+
+    def expected_costs(self):
+        """
+        Returns the expected one-step cost of every (state, action) pair of the compiled transition model. The cost
+        function is evaluated only once per transition, see 'cost_functions.transition_costs'.
+        :return: Array of shape [num_states, num_actions]
+        """
+        model = self.world.compile()
+        return model.expected_costs(transition_costs(self.world, self.one_step_cost_fn))
+
     def extract_policy(self):
         """
         Computes the greedily induced policy from the current value function
         :return: The greedy policy for the current value function.
         """
+        return self.world.compile().indices_to_policy(self.extract_policy_actions(), np.float32)
 
-        optimal_policy = np.zeros([self.world.world_height, self.world.world_width, 2], np.float32)
-
-        for y in range(self.world.world_height):
-            for x in range(self.world.world_width):
-                state = np.array([x, y], np.int32)
-                if self.world.is_wall(state):
-                    continue
+    def extract_policy_actions(self):
+        """
+        Computes the greedily induced policy from the current value function in compact form, i.e. as the index of the
+        greedy action of every free state. 'TransitionModel.indices_to_policy' converts it into the vector form.
+        :return: Array of shape [num_states] and type uint8
+        """
+        model = self.world.compile()
+        if self.engine != 'loop':
+            q = model.q_values(self.expected_costs(), model.to_flat(self.value_fn), self.discount_factor)
+            return np.argmin(q, axis=1).astype(np.uint8)
 
-                min_cost = 10e6
-                min_cost_action = None
+        one_step_costs = transition_costs(self.world, self.one_step_cost_fn)
+        values = model.to_flat(self.value_fn)
+        optimal_actions = np.zeros(model.num_states, np.uint8)
 
-                for action in self.world.actions:
-                    if not self.world.is_action_allowed(state, action):
-                        continue
+        for s, state in enumerate(model.states):
+            min_cost = 10e6
+            min_cost_action = None
 
-                    transitions = self.world.get_transitions(state, action)
+            for a in np.flatnonzero(model.action_mask[s]):
+                next_states, probs = model.transitions(s, a)
+                costs = one_step_costs[model.transition_slice(s, a)]
 
-                    cost_fn = sum([transition_prob * (self.one_step_cost_fn(state, next_state) +
-                                                      (self.discount_factor * self.value_fn[next_state[1], next_state[0]]))
-                                   for next_state, transition_prob in transitions])
+                cost_fn = sum([transition_prob * (cost + (self.discount_factor * values[next_state]))
+                               for next_state, transition_prob, cost in zip(next_states, probs, costs)])
 
-                    if cost_fn < min_cost:
-                        min_cost = cost_fn
-                        min_cost_action = action
+                if cost_fn < min_cost:
+                    min_cost = cost_fn
+                    min_cost_action = a
 
-                if min_cost_action is None:
-                    raise ValueError("No action found for state (%d, %d)", x, y)
-                else:
-                    optimal_policy[y, x] = min_cost_action
+            if min_cost_action is None:
+                raise ValueError("No action found for state (%d, %d)" % (state[0], state[1]))
+            else:
+                optimal_actions[s] = min_cost_action
 
-        return optimal_policy
+        return optimal_actions
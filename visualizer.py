@@ -1,5 +1,8 @@
 from copy import copy
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
+import matplotlib.animation
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -9,26 +12,14 @@ class Visualizer(object):
         self.world = world
 
     def draw(self, fig, policy, value_fn, title):
-        value_fn_flipped = np.flipud(value_fn)
-        arrow_dirs = np.flip(policy, axis=0)
+        value_fn_flipped = np.flipud(value_fn).astype(np.float64)
+        arrow_dirs = np.flip(policy, axis=0).astype(np.float64)
         arrow_dirs[:, :, 1] *= -1
 
-        arrow_loc_x = list()
-        arrow_loc_y = list()
-        arrow_dir_x = list()
-        arrow_dir_y = list()
+        arrow_loc_y, arrow_loc_x = np.mgrid[0:self.world.world_height, 0:self.world.world_width] + 0.5
 
         wall_value = np.min(value_fn_flipped) - 1.
-
-        for y in range(self.world.world_height):
-            for x in range(self.world.world_width):
-                arrow_loc_x.append(x + 0.5)
-                arrow_loc_y.append(y + 0.5)
-                arrow_dir_x.append(arrow_dirs[y, x, 0])
-                arrow_dir_y.append(arrow_dirs[y, x, 1])
-
-                if self.world.is_wall((x, self.world.world_height - y - 1)):
-                    value_fn_flipped[y, x] = wall_value
+        value_fn_flipped[np.flipud(self.world.wall_mask)] = wall_value
 
         ax = fig.add_subplot(111)
         ax.set_title(title)
@@ -43,5 +34,108 @@ class Visualizer(object):
         cax = fig.add_axes([0.85, 0.15, 0.03, 0.7])
         fig.colorbar(pcolor, cax=cax, orientation='vertical')
 
-        ax.quiver(arrow_loc_x, arrow_loc_y, arrow_dir_x, arrow_dir_y, angles='xy', scale_units='xy', scale=1.4)
+        ax.quiver(arrow_loc_x.ravel(), arrow_loc_y.ravel(), arrow_dirs[:, :, 0].ravel(), arrow_dirs[:, :, 1].ravel(),
+                  angles='xy', scale_units='xy', scale=1.4)
         fig.subplots_adjust(right=0.8)
+
+    def render(self, filepath, value_fn, policy=None, title=None, max_arrows=64, dpi=100):
+        """
+        Renders the value function as a raster image, optionally overlaid with the policy, and writes it to an image
+        file. Unlike 'draw', this does not depend on pyplot or a display and scales to large worlds: walls are masked
+        out of the image instead of drawn as separate cells, and the policy arrows are subsampled.
+
+        :param filepath: Full path to the output image, e.g. a .png file
+        :param value_fn: Value function as a 2D array
+        :param policy: Policy as an array of shape [H, W, 2], or None to render the value function only
+        :param title: Title of the plot
+        :param max_arrows: Maximum number of arrows along either side of the map. For larger maps, only the policy of
+        every k-th cell in both directions is drawn.
+        :param dpi: Resolution of the output image
+        :return: None
+        """
+        fig, ax, image = self.__create_figure(value_fn, title)
+        if policy is not None:
+            self.__draw_arrows(ax, policy, max_arrows)
+        fig.savefig(filepath, dpi=dpi)
+
+    def render_history(self, history, filepath, fps=10, title=None, dpi=100):
+        """
+        Renders every value function of a history, e.g. the 'value_fn_history' of a solver, using a single figure whose
+        image data is replaced for every frame. The color scale is fixed over all frames.
+
+        :param history: Iterable of 2D value functions. If it has an 'iterations' attribute like 'ValueFnHistory', the
+        frames are labelled with the corresponding iteration numbers.
+        :param filepath: Full path to an animation (.gif or .mp4) or a pattern for a sequence of images which contains
+        a format specifier for the frame number, e.g. 'frames/frame_%04d.png'
+        :param fps: Frames per second of animations
+        :param title: Title of the plot, followed by the iteration number of the frame
+        :param dpi: Resolution of the output
+        :return: Number of rendered frames
+        """
+        walls = self.world.wall_mask
+        vmin, vmax = np.inf, -np.inf
+        num_frames = 0
+        for value_fn in history:
+            free_values = np.asarray(value_fn)[~walls]
+            vmin = min(vmin, float(free_values.min(initial=np.inf)))
+            vmax = max(vmax, float(free_values.max(initial=-np.inf)))
+            num_frames += 1
+
+        if num_frames == 0:
+            return 0
+        is_animation = filepath.endswith('.gif') or filepath.endswith('.mp4')
+        if not is_animation and '%' not in filepath:
+            raise ValueError("The path of a frame sequence must contain a format specifier for the frame number")
+
+        iterations = list(getattr(history, 'iterations', range(num_frames)))
+        title = title + ", " if title else ""
+        fig, ax, image = self.__create_figure(np.full(walls.shape, vmin), title, vmin, vmax)
+
+        def frames():
+            for i, value_fn in enumerate(history):
+                image.set_data(np.ma.masked_array(value_fn, mask=walls))
+                ax.set_title("%siteration %d" % (title, iterations[i]))
+                yield i
+
+        if is_animation:
+            writer = matplotlib.animation.PillowWriter(fps=fps) if filepath.endswith('.gif') else \
+                matplotlib.animation.FFMpegWriter(fps=fps)
+            with writer.saving(fig, filepath, dpi):
+                for _ in frames():
+                    writer.grab_frame()
+        else:
+            for i in frames():
+                fig.savefig(filepath % i, dpi=dpi)
+
+        return num_frames
+
+    def __create_figure(self, value_fn, title, vmin=None, vmax=None):
+        # creates a figure outside of pyplot, so that nothing is shown and no figure manager keeps it alive
+        height, width = self.world.map.shape
+        scale = 8. / max(height, width)
+        fig = Figure(figsize=(max(width * scale, 3.) + 1.5, max(height * scale, 3.) + 0.8))
+        FigureCanvasAgg(fig)
+
+        ax = fig.add_subplot(111)
+        if title:
+            ax.set_title(title)
+
+        color_map = copy(plt.cm.viridis)
+        color_map.set_bad('k', 1.0)
+        image = ax.imshow(np.ma.masked_array(value_fn, mask=self.world.wall_mask), cmap=color_map, vmin=vmin,
+                          vmax=vmax, interpolation='nearest', extent=(0, width, height, 0))
+        fig.colorbar(image, ax=ax)
+        return fig, ax, image
+
+    def __draw_arrows(self, ax, policy, max_arrows):
+        height, width = self.world.map.shape
+        stride = max(1, int(np.ceil(max(height, width) / float(max_arrows))))
+
+        ys, xs = np.mgrid[stride // 2:height:stride, stride // 2:width:stride]
+        free = ~self.world.wall_mask[ys, xs]
+        xs, ys = xs[free], ys[free]
+        directions = np.asarray(policy, np.float64)[ys, xs]
+
+        # the y axis of the image points down, just like the y component of the actions
+        ax.quiver(xs + 0.5, ys + 0.5, directions[:, 0], directions[:, 1], angles='xy', scale_units='xy',
+                  scale=1.4 / stride)
@@ -1,12 +1,24 @@
+from transition_model import TransitionModel
+
+import hashlib
 import numpy as np
+import struct
 
 
 class World(object):
-    def __init__(self, world_map_path):
+    # layout of binary world map files: a fixed-size header followed by the occupancy grid as raw uint8 cells in
+    # row-major order, so that the grid can be memory-mapped directly
+    BINARY_MAGIC       = b'WMAP'
+    BINARY_VERSION     = 1
+    BINARY_HEADER      = struct.Struct('<4sIII6i')
+    BINARY_HEADER_SIZE = 64
+
+    def __init__(self, world_map_path=None):
         """
         Ctor for World class.
 
-        :param world_map_path: Full path to text file containing definition of the 2D world maze.
+        :param world_map_path: Full path to text file containing definition of the 2D world maze, or to a binary world
+        map file as written by 'write_binary_world_map'. If None, the world is empty until 'set_grid' is called.
         """
         self.map          = None
 
@@ -23,6 +35,11 @@ class World(object):
         self.TRAP_TOKEN   = 'T'
         self.START_TOKEN  = 'S'
 
+        # cell values of the occupancy grid 'map'. Start, goal and trap cells are free cells whose positions are
+        # stored separately.
+        self.FREE_CELL    = 0
+        self.WALL_CELL    = 1
+
         self.ACTION_UP    = np.array([0, -1], dtype=np.int32)
         self.ACTION_RIGHT = np.array([1, 0],  dtype=np.int32)
         self.ACTION_DOWN  = np.array([0, 1],  dtype=np.int32)
@@ -30,50 +47,222 @@ class World(object):
         self.ACTION_IDLE  = np.array([0, 0],  dtype=np.int32)
 
         self.action_stochasticity = 0.1
+        self.__model              = None
 
-        self.read_world_map(world_map_path)
+        if world_map_path is None:
+            return
+        elif self.is_binary_world_map(world_map_path):
+            self.read_binary_world_map(world_map_path)
+        else:
+            self.read_world_map(world_map_path)
 
     def read_world_map(self, filepath):
         """
-        Parses the world maze definition.
+        Parses the world maze definition. The file is streamed line by line, and every line is converted into a row of
+        the uint8 occupancy grid.
 
         :param filepath: Full path to text file containing definition of the 2D world maze.
         :return: None
         """
-        with open(filepath) as readfile:
-            content = readfile.readlines()
+        wall_token = self.WALL_TOKEN.encode()
+        special_tokens = [token.encode() for token in (self.START_TOKEN, self.GOAL_TOKEN, self.TRAP_TOKEN)]
+        special_cells = dict()
 
         map_width = -1
         world_map = list()
-        content_start_row = -1
 
-        for i, line in enumerate(content):
-            line = line.rstrip()
-            if line.startswith('#') or line is None:  # skip commented and empty lines at the start of file
-                continue
+        with open(filepath, 'rb') as readfile:
+            for line in readfile:
+                line = line.rstrip()
+                if line.startswith(b'#') or not line:  # skip commented and empty lines
+                    continue
+
+                if len(line) % 2 == 1 and line[1::2] == b' ' * (len(line) // 2):
+                    # fast path for the common case of single-character tokens separated by single spaces
+                    tokens = np.frombuffer(line[::2], np.uint8)
+                    row = (tokens == ord(wall_token)).astype(np.uint8)
+                    special_xs = np.flatnonzero((tokens != ord(wall_token)) & (tokens != ord(self.FREE_TOKEN)))
+                    special = [(x, line[2 * x:2 * x + 1]) for x in special_xs]
+                else:
+                    tokens = line.split(b' ')
+                    row = np.array([token == wall_token for token in tokens], np.uint8)
+                    special = [(x, token) for x, token in enumerate(tokens) if token in special_tokens]
+
+                if map_width != len(row) and map_width != -1:
+                    raise ValueError("All lines in the file should have the same number of tokens")
+
+                map_width = len(row)
+                for x, token in special:
+                    special_cells[token] = (x, len(world_map))
+                world_map.append(row)
+
+        self.map = np.array(world_map, np.uint8)
+        self.__start_x, self.__start_y = special_cells.get(special_tokens[0], (-1, -1))
+        self.__goal_x, self.__goal_y = special_cells.get(special_tokens[1], (-1, -1))
+        self.__trap_x, self.__trap_y = special_cells.get(special_tokens[2], (-1, -1))
+        self.__model = None
+
+    def is_binary_world_map(self, filepath):
+        with open(filepath, 'rb') as readfile:
+            return readfile.read(len(self.BINARY_MAGIC)) == self.BINARY_MAGIC
+
+    def read_binary_world_map(self, filepath):
+        """
+        Loads a binary world map file. The occupancy grid is memory-mapped rather than read, so that loading takes
+        constant time regardless of the size of the world.
+
+        :param filepath: Full path to a binary world map file as written by 'write_binary_world_map'
+        :return: None
+        """
+        with open(filepath, 'rb') as readfile:
+            header = self.BINARY_HEADER.unpack(readfile.read(self.BINARY_HEADER.size))
+
+        magic, version, height, width = header[:4]
+        if magic != self.BINARY_MAGIC or version != self.BINARY_VERSION:
+            raise ValueError("%s is not a binary world map file of version %d" % (filepath, self.BINARY_VERSION))
+
+        # copy-on-write, so that the world can be modified in memory without touching the file
+        occupancy = np.memmap(filepath, np.uint8, mode='c', offset=self.BINARY_HEADER_SIZE, shape=(height, width))
+        start_x, start_y, goal_x, goal_y, trap_x, trap_y = header[4:]
+        self.set_grid(occupancy, (start_x, start_y), (goal_x, goal_y), (trap_x, trap_y))
+
+    def set_grid(self, occupancy, start_pos, goal_pos, trap_pos):
+        """
+        Sets the world from an occupancy grid, without copying it.
+
+        :param occupancy: uint8 array of shape [H, W] in which walls are marked with 'WALL_CELL'
+        :param start_pos: (x, y) position of the start cell, or (-1, -1) if there is none
+        :param goal_pos: (x, y) position of the goal cell, or (-1, -1) if there is none
+        :param trap_pos: (x, y) position of the trap cell, or (-1, -1) if there is none
+        :return: None
+        """
+        self.map = occupancy
+        self.__start_x, self.__start_y = int(start_pos[0]), int(start_pos[1])
+        self.__goal_x, self.__goal_y = int(goal_pos[0]), int(goal_pos[1])
+        self.__trap_x, self.__trap_y = int(trap_pos[0]), int(trap_pos[1])
+        self.__model = None
+
+    def set_wall(self, pos, is_wall=True):
+        """
+        Turns a single cell into a wall or frees it. The compiled transition model is rebuilt on the next call to
+        'compile'. Solvers can then update their solution with 'resolve' instead of starting from scratch.
 
-            if content_start_row == -1:
-                content_start_row = i
+        :param pos: (x, y) position of the cell
+        :param is_wall: True to place a wall, False to free the cell
+        :return: None
+        """
+        if not self.is_within_bounds(pos):
+            raise ValueError("The position (%d, %d) is out of bounds" % (pos[0], pos[1]))
+        if is_wall and any((pos == special_pos).all() for special_pos in (self.start_pos, self.goal_pos, self.trap_pos)):
+            raise ValueError("The start, goal or trap cell at (%d, %d) cannot be turned into a wall" % (pos[0], pos[1]))
 
-            tokens = line.split(' ')
-            if map_width != len(tokens) and map_width != -1:
-                raise ValueError("All lines in the file should have the same number of tokens")
+        cell = self.WALL_CELL if is_wall else self.FREE_CELL
+        if self.map[pos[1], pos[0]] == cell:
+            return
 
-            map_width = len(tokens)
-            world_map.append(tokens)
+        if not self.map.flags.writeable:
+            self.map = np.array(self.map)
+        self.map[pos[1], pos[0]] = cell
+        self.__model = None
 
-            for j, token in enumerate(tokens):
-                if token == self.START_TOKEN:
-                    self.__start_x = j
-                    self.__start_y = i - content_start_row
-                elif token == self.GOAL_TOKEN:
-                    self.__goal_x = j
-                    self.__goal_y = i - content_start_row
-                elif token == self.TRAP_TOKEN:
-                    self.__trap_x = j
-                    self.__trap_y = i - content_start_row
+    def set_goal_pos(self, pos):
+        """
+        Moves the goal to another free cell. The compiled transitions do not depend on the goal and are kept, only the
+        cached one-step costs are dropped.
 
-        self.map = np.array(world_map)
+        :param pos: (x, y) position of the new goal cell
+        :return: None
+        """
+        self.__check_free_cell(pos)
+        self.__goal_x, self.__goal_y = int(pos[0]), int(pos[1])
+        self.__invalidate_costs()
+
+    def set_trap_pos(self, pos):
+        """
+        Moves the trap to another free cell. The compiled transitions are kept, only the cached one-step costs are
+        dropped.
+
+        :param pos: (x, y) position of the new trap cell
+        :return: None
+        """
+        self.__check_free_cell(pos)
+        self.__trap_x, self.__trap_y = int(pos[0]), int(pos[1])
+        self.__invalidate_costs()
+
+    def set_start_pos(self, pos):
+        """
+        Moves the start to another free cell.
+
+        :param pos: (x, y) position of the new start cell
+        :return: None
+        """
+        self.__check_free_cell(pos)
+        self.__start_x, self.__start_y = int(pos[0]), int(pos[1])
+        self.__invalidate_costs()
+
+    def __check_free_cell(self, pos):
+        if not self.is_within_bounds(pos) or self.is_wall(pos):
+            raise ValueError("The position (%d, %d) is not a free cell" % (pos[0], pos[1]))
+
+    def __invalidate_costs(self):
+        # one-step cost functions receive the world and may depend on the positions of the special cells
+        if self.__model is not None:
+            self.__model.cost_cache.clear()
+
+    def write_binary_world_map(self, filepath):
+        """
+        Writes the world to a binary world map file which can be loaded much faster than the text definition.
+
+        :param filepath: Full path to the output file
+        :return: None
+        """
+        header = self.BINARY_HEADER.pack(self.BINARY_MAGIC, self.BINARY_VERSION, self.world_height, self.world_width,
+                                         self.__start_x, self.__start_y, self.__goal_x, self.__goal_y, self.__trap_x,
+                                         self.__trap_y)
+
+        with open(filepath, 'wb') as writefile:
+            writefile.write(header.ljust(self.BINARY_HEADER_SIZE, b'\0'))
+            writefile.write(np.ascontiguousarray(self.map, np.uint8).tobytes())
+
+    def fingerprint(self):
+        """
+        Returns a hash of everything that determines the dynamics of the world: the occupancy grid, the positions of the
+        special cells and 'action_stochasticity'. Worlds with the same fingerprint have the same solutions.
+
+        :return: Hex digest
+        """
+        digest = hashlib.sha256()
+        digest.update(struct.pack('<2q', *self.map.shape))
+        digest.update(np.ascontiguousarray(self.map, np.uint8).tobytes())
+        digest.update(struct.pack('<6q', self.__start_x, self.__start_y, self.__goal_x, self.__goal_y, self.__trap_x,
+                                  self.__trap_y))
+        digest.update(repr(float(self.action_stochasticity)).encode())
+        return digest.hexdigest()
+
+    def compile(self):
+        """
+        Compiles the transition dynamics of the world into flat arrays which the solvers can consume directly. The
+        compiled model is cached and only rebuilt if the map or 'action_stochasticity' have changed since.
+
+        :return: Instance of class 'TransitionModel'
+        """
+        if self.__model is None or self.__model.action_stochasticity != self.action_stochasticity:
+            self.__model = TransitionModel(self)
+        return self.__model
+
+    def attach_model(self, model):
+        """
+        Uses an already compiled transition model of this world instead of compiling it again, e.g. one which is shared
+        between processes.
+
+        :param model: Instance of class 'TransitionModel' compiled from a world with the same map
+        :return: None
+        """
+        if model.world_shape != self.map.shape:
+            raise ValueError("The transition model was compiled for a world of shape %s, not %s" %
+                             (str(model.world_shape), str(self.map.shape)))
+        self.action_stochasticity = model.action_stochasticity
+        self.__model = model
 
     def get_residual_transitions(self, action):
         assert (action != self.ACTION_IDLE).all()
@@ -81,7 +270,7 @@ class World(object):
         return action + perturbation, action - perturbation
 
     def is_wall(self, pos):
-        return self.map[pos[1], pos[0]] == self.WALL_TOKEN
+        return self.map[pos[1], pos[0]] == self.WALL_CELL
 
     def is_within_bounds(self, pos):
         return 0 <= pos[0] < self.map.shape[1] and 0 <= pos[1] < self.map.shape[0]
@@ -147,6 +336,7 @@ class World(object):
     goal_pos     = property(fget=lambda self: np.array([self.__goal_x, self.__goal_y], np.int32))
     start_pos    = property(fget=lambda self: np.array([self.__start_x, self.__start_y], np.int32))
     trap_pos     = property(fget=lambda self: np.array([self.__trap_x, self.__trap_y], np.int32))
+    wall_mask    = property(fget=lambda self: self.map == self.WALL_CELL)
     world_width  = property(fget=lambda self: self.map.shape[1])
     world_height = property(fget=lambda self: self.map.shape[0])
     actions      = property(fget=lambda self: [self.ACTION_UP, self.ACTION_RIGHT, self.ACTION_DOWN, self.ACTION_LEFT,